@@ -0,0 +1,146 @@
+"""
+cache.py : Persistent caches for file metadata
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from epc.common.settings import Config
+
+
+class PersistentCache(object):
+    """
+    SQLite backed key / value store with a bounded size and LRU eviction
+
+    Values must be JSON serializable. Writes are committed every COMMIT_INTERVAL operations and on flush().
+    """
+    COMMIT_INTERVAL = 1000
+    EVICT_RATIO = 0.9
+
+    def __init__(self, name, max_entries=1000000, path=None):
+        if not path:
+            os.makedirs(Config().BINCACHE_DIR, exist_ok=True)
+            path = os.path.join(Config().BINCACHE_DIR, '{}.sqlite'.format(name))
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, last_used REAL)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)')
+        self.__count = self.__db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    @staticmethod
+    def make_key(*parts):
+        """Build a key from its parts"""
+        return '|'.join(str(part) for part in parts)
+
+    def get(self, key):
+        """Get a value from the cache, returns None if the key is not cached"""
+        with self.__lock:
+            row = self.__db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__db.execute('UPDATE cache SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.__written()
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            logging.warning("Invalid cache entry %s", key)
+            return None
+
+    def set(self, key, value):
+        """Store a value in the cache, evicting the least recently used entries if the cache is full"""
+        data = json.dumps(value)
+        with self.__lock:
+            cursor = self.__db.execute('UPDATE cache SET value = ?, last_used = ? WHERE key = ?',
+                                       (data, time.time(), key))
+            if not cursor.rowcount:
+                self.__db.execute('INSERT INTO cache (key, value, last_used) VALUES (?, ?, ?)',
+                                  (key, data, time.time()))
+                self.__count += 1
+                if self.__count > self.max_entries:
+                    self.__evict()
+            self.__written()
+
+    def delete(self, key):
+        """Remove a value from the cache"""
+        with self.__lock:
+            cursor = self.__db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self.__count -= cursor.rowcount
+            self.__written()
+
+    def __evict(self):
+        """Remove the least recently used entries, leaving some room to avoid evicting on each insert"""
+        to_remove = self.__count - int(self.max_entries * self.EVICT_RATIO)
+        self.__db.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)', (to_remove,))
+        self.__count = self.__db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def __written(self):
+        self.__pending += 1
+        if self.__pending >= self.COMMIT_INTERVAL:
+            self.__db.commit()
+            self.__pending = 0
+
+    def __len__(self):
+        return self.__count
+
+    def stats(self):
+        """Get the cache statistics"""
+        return dict(
+            entries=self.__count,
+            max_entries=self.max_entries,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+    def flush(self):
+        """Commit the pending writes"""
+        with self.__lock:
+            self.__db.commit()
+            self.__pending = 0
+
+    def close(self):
+        """Commit the pending writes and close the database"""
+        self.flush()
+        self.__db.close()
+
+
+class HashCache(PersistentCache):
+    """Persistent cache of the file digests, keyed by volume, inode, size, mtime and ctime"""
+
+    def __init__(self, max_entries=1000000, path=None):
+        super(HashCache, self).__init__('hashcache', max_entries, path)
+
+
+class PEMetadataCache(PersistentCache):
+    """Persistent cache of the PE metadata, keyed by volume, inode, size, mtime and ctime"""
+
+    def __init__(self, max_entries=1000000, path=None):
+        super(PEMetadataCache, self).__init__('pecache', max_entries, path)
@@ -18,25 +18,236 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import collections
+import itertools
 import os
+import re
+import stat
+import struct
 from pathlib import Path
 from typing import Iterator
 
 from epc.common.platform import PlatformData
 from epc.common.settings import Config
-from .file import TSKFile, AndroidFile
+from .file import TSKFile, AndroidFile, NativeFile
+from .rawdevice import RawDevice
+
+# $FILE_NAME namespaces, the DOS 8.3 names are only used when a file has no other name
+NTFS_NAMESPACE_DOS = 2
+NTFS_ROOT_INODE = 5
+NTFS_ORPHAN_PATH = Path('/$OrphanFiles')
+
+
+class _MFTName(object):
+    """Name of a MFT entry, mimics the TSK_FS_NAME of a directory entry"""
+    __slots__ = ('name', 'type', 'flags')
+
+    def __init__(self, name, name_type, flags):
+        self.name = name
+        self.type = name_type
+        self.flags = flags
+
+
+class _MFTInfo(object):
+    __slots__ = ('meta', 'name')
+
+    def __init__(self, meta, name):
+        self.meta = meta
+        self.name = name
+
+
+class _MFTEntry(object):
+    """File opened from its MFT entry, gives it the name read from its $FILE_NAME attribute"""
+    __slots__ = ('__file', 'info')
+
+    def __init__(self, tsk_file, name):
+        self.__file = tsk_file
+        self.info = _MFTInfo(tsk_file.info.meta, name)
+
+    def __iter__(self):
+        return iter(self.__file)
+
+    def read_random(self, *args, **kwargs):
+        return self.__file.read_random(*args, **kwargs)
+
+
+def _ntfs_file_name(tsk_file):
+    """
+    Read the name and parent of a MFT entry from its $FILE_NAME attributes
+
+    Returns:
+        tuple (name, parent inode, parent sequence)
+        None if the entry has no $FILE_NAME
+    """
+    import pytsk3
+    best = None
+    for attribute in tsk_file:
+        if int(attribute.info.type) != pytsk3.TSK_FS_ATTR_TYPE_NTFS_FNAME:
+            continue
+        data = tsk_file.read_random(0, attribute.info.size, attribute.info.type, attribute.info.id)
+        if len(data) < 0x42:
+            continue
+        parent_reference, = struct.unpack_from('<Q', data, 0)
+        name_length, namespace = struct.unpack_from('<BB', data, 0x40)
+        name = data[0x42:0x42 + name_length * 2].decode('utf-16-le', errors='replace').encode('utf-8')
+        best = (name, parent_reference & 0xffffffffffff, parent_reference >> 48)
+        if namespace != NTFS_NAMESPACE_DOS:
+            break
+    return best
+
+
+def _join(parent, name):
+    """Join a path string and a name, faster than building a Path for each directory entry"""
+    return parent.rstrip('/') + '/' + name
+
+
+def _close_scandir(entries):
+    """Release the directory descriptor of an os.scandir iterator (close() only exists from Python 3.6)"""
+    close = getattr(entries, 'close', None)
+    if close is not None:
+        close()
+
+
+def _stat_meta(entry):
+    """Size and mtime of a os.DirEntry, for FileFilter.match_entry"""
+    st = entry.stat(follow_symlinks=False)
+    return st.st_size, st.st_mtime
+
+
+# Mounted file system, mountpoints lists the other mount points of the same tree
+Volume = collections.namedtuple(
+    'Volume', ('device', 'mountpoint', 'fs_type', 'dev', 'root', 'disk', 'rotational', 'mountpoints'))
+
+
+def _block_device_info(dev, device=None):
+    """
+    Get the disk of a block device and whether it is rotational from /sys
+
+    Args:
+        dev: 'major:minor' of the device
+        device: source of the mount, its device number is used when dev is not a block device (the anonymous
+                0:NN of btrfs)
+
+    Returns:
+        tuple (disk name, rotational), None values if unknown (network and virtual file systems)
+    """
+    path = os.path.realpath('/sys/dev/block/{}'.format(dev))
+    if not os.path.isdir(path) and device and device.startswith('/'):
+        try:
+            device_stat = os.stat(device)
+        except OSError:
+            return None, None
+        if not stat.S_ISBLK(device_stat.st_mode):
+            return None, None
+        path = os.path.realpath('/sys/dev/block/{}:{}'.format(
+            os.major(device_stat.st_rdev), os.minor(device_stat.st_rdev)))
+    if not os.path.isdir(path):
+        return None, None
+    if os.path.exists(os.path.join(path, 'partition')):
+        # The queue of a partition is the one of its disk
+        path = os.path.dirname(path)
+    try:
+        with open(os.path.join(path, 'queue', 'rotational')) as ifile:
+            rotational = ifile.read().strip() == '1'
+    except OSError:
+        rotational = None
+    return os.path.basename(path), rotational
+
+
+def _unescape_mount(field):
+    """Decode the octal escapes (\\040 for spaces...) of a /proc/mounts field"""
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+
+def _same_device(device, drive_name):
+    """Compare the device of a mount with a drive name, following the links (/dev/disk/by-uuid/..., /dev/root)"""
+    if device == drive_name:
+        return True
+    if not device.startswith('/') or not drive_name.startswith('/'):
+        return False
+    return os.path.realpath(device) == os.path.realpath(drive_name)
+
+
+def _mount_points():
+    """Get the mount points listed in /proc/self/mountinfo, an empty set if it is not available"""
+    try:
+        with open('/proc/self/mountinfo') as ifile:
+            return {_unescape_mount(line.split()[4]) for line in ifile if len(line.split()) > 4}
+    except OSError:
+        return set()
+
+
+def _btrfs_subvolume(options):
+    """Get the subvolume of a btrfs mount from its super options (subvol=/@home,...), None if not listed"""
+    for option in options.split(','):
+        if option.startswith('subvol='):
+            return _unescape_mount(option[len('subvol='):])
+    return None
 
 
 class DriveManager(object):
-    def __init__(self):
+    # File systems read with libtsk, mounted file systems of other types are listed with NativeDrive
+    TSK_FILESYSTEMS = ('ext2', 'ext3', 'ext4', 'ntfs', 'ntfs3', 'fuseblk', 'vfat', 'msdos', 'exfat', 'hfs', 'hfsplus',
+                       'iso9660', 'ufs', 'apfs')
+    # Mounted file systems without a device path which can still be scanned
+    NATIVE_FILESYSTEMS = ('overlay', 'nfs', 'nfs4', 'cifs', 'smb3', 'zfs', 'btrfs', 'xfs', 'f2fs', 'fuse.sshfs')
+
+    def __init__(self, native_filesystems=None, raw_backend=False):
+        """
+        Args:
+            native_filesystems: file system types listed with NativeDrive even if libtsk can read them (ex: 'ext4')
+            raw_backend: libtsk reads the TSK drives through RawDevice instead of its own image reader
+        """
+        self.__native_filesystems = tuple(native_filesystems or ())
+        self.__raw_backend = raw_backend
         if Config().PLATFORM == 'android':
             self.__class = self.AndroidDrive
         else:
             self.__class = self.TSKDrive
 
     def open(self, drive_name, basepath=None):
+        if self.__class is self.TSKDrive:
+            mount = self.get_mount(drive_name, basepath)
+            if mount and (mount[1] not in self.TSK_FILESYSTEMS or mount[1] in self.__native_filesystems):
+                return self.NativeDrive(drive_name, mount[0])
+            return self.TSKDrive(drive_name, basepath, self.__raw_backend)
         return self.__class(drive_name, basepath)
 
+    @staticmethod
+    def get_mount(drive_name, basepath=None):
+        """
+        Get a mounted file system from /proc/mounts
+
+        Args:
+            drive_name: device of the file system
+            basepath: mount point of the file system (default: look for drive_name), the mount must also be
+                      of drive_name unless drive_name is basepath itself
+
+        Returns:
+            tuple (mount point, file system type)
+            None if the file system is not mounted (disk images...) or /proc/mounts is not available
+        """
+        try:
+            with open('/proc/mounts') as ifile:
+                lines = ifile.readlines()
+        except OSError:
+            return None
+        check_device = drive_name and drive_name != basepath
+        mount = None
+        for line in lines:
+            infos = line.split(' ')
+            if len(infos) < 3:
+                continue
+            device, mountpoint = _unescape_mount(infos[0]), _unescape_mount(infos[1])
+            # The last matching mount hides the previous ones
+            if basepath:
+                if mountpoint == basepath or mountpoint == basepath.rstrip('/'):
+                    # Another device mounted there (image of a mounted file system...) is not this drive
+                    mount = (basepath, infos[2]) if not check_device or _same_device(device, drive_name) else None
+            elif _same_device(device, drive_name):
+                mount = (mountpoint, infos[2])
+        return mount
+
     @staticmethod
     def list_available(filesystems=None):
         """
@@ -82,16 +293,22 @@ class DriveManager(object):
                     return drives
                 except (ImportError, ValueError):
                     pass
+        volumes = DriveManager.list_volumes(filesystems)
+        if volumes is not None:
+            drives = [(volume.device, volume.mountpoint) for volume in volumes]
+            if Config().PLATFORM == 'android':
+                drives.append(('/sdcard', '/sdcard'))
+            return drives
         try:
             # Linux and Android method
             with open('/proc/mounts') as ifile:
                 for lines in ifile.readlines():
                     infos = lines.split(' ')
-                    if not infos[0].startswith('/'):
+                    if not infos[0].startswith('/') and infos[2] not in DriveManager.NATIVE_FILESYSTEMS:
                         continue  # Don't scan virtual file systems
                     if filesystems and not infos[2] in filesystems:
                         continue
-                    drives.append((infos[0], infos[1]))
+                    drives.append((_unescape_mount(infos[0]), _unescape_mount(infos[1])))
         except FileNotFoundError:
             pass
 
@@ -100,6 +317,75 @@ class DriveManager(object):
 
         return drives
 
+    @staticmethod
+    def list_volumes(filesystems=None):
+        """
+        Get the mounted volumes from /proc/self/mountinfo, each file system tree once
+
+        The mounts of the same device and root (bind mounts, file systems mounted twice) are collapsed into the
+        one with the shortest mount point, as are the bind mounts of a directory of an already listed mount.
+        btrfs subvolumes have their own st_dev and are not walked from the mounts of their parent subvolume: a
+        btrfs mount is only collapsed into a mount of the same subvolume.
+
+        Args:
+            filesystems: only list these file system types
+
+        Returns:
+            list of Volume
+            None if /proc/self/mountinfo is not available
+        """
+        try:
+            with open('/proc/self/mountinfo') as ifile:
+                lines = ifile.readlines()
+        except OSError:
+            return None
+
+        mounts = []
+        for line in lines:
+            infos = line.split()
+            try:
+                separator = infos.index('-', 6)
+            except ValueError:
+                continue
+            dev, root, mountpoint = infos[2], _unescape_mount(infos[3]), _unescape_mount(infos[4])
+            fs_type, device = infos[separator + 1], _unescape_mount(infos[separator + 2])
+            if not device.startswith('/') and fs_type not in DriveManager.NATIVE_FILESYSTEMS:
+                continue  # Don't scan virtual file systems
+            if filesystems and fs_type not in filesystems:
+                continue
+            subvolume = None
+            if fs_type == 'btrfs' and len(infos) > separator + 3:
+                subvolume = _btrfs_subvolume(infos[separator + 3])
+            mounts.append((dev, root, mountpoint, fs_type, device, subvolume))
+
+        # The shortest root first: its bind mounts and sub-directories are collapsed into it
+        kept = collections.OrderedDict()
+        subvolumes = dict()
+        for dev, root, mountpoint, fs_type, device, subvolume in sorted(
+                mounts, key=lambda mount: (mount[0], len(mount[1]), len(mount[2]))):
+            target = None
+            for key, volume in kept.items():
+                if key[0] != dev:
+                    continue
+                if root == key[1]:
+                    target = key
+                    break
+                # Sub-directory of the mount, on btrfs only if it is in the same (known) subvolume
+                if root.startswith(key[1].rstrip('/') + '/') and (
+                        fs_type != 'btrfs' or (subvolume is not None and subvolume == subvolumes[key])):
+                    target = key
+                    break
+            if target is not None:
+                kept[target].mountpoints.append(mountpoint)
+                continue
+            disk, rotational = _block_device_info(dev, device)
+            kept[(dev, root)] = Volume(device, mountpoint, fs_type, dev, root, disk, rotational, [])
+            subvolumes[(dev, root)] = subvolume
+
+        # Keep the mount order of the system
+        order = {mount[2]: index for index, mount in enumerate(mounts)}
+        return sorted(kept.values(), key=lambda volume: order[volume.mountpoint])
+
     class Drive(object):
         """
         Generic Drive object
@@ -109,45 +395,107 @@ class DriveManager(object):
         def __init__(self, drive_name, basepath=None):
             self._drive_name = drive_name
             self._basepath = basepath if basepath else self._drive_name
-            self.drive_fd = 0
+            self._raw_device = None
+            self._disk_pos = 0
+            self.hash_cache = None
+            self.pe_cache = None
 
             self._recursive = True
-
-        def enumerate_files(self, directory=None, recurse_callback=None):
+            # Maximum depth below the listed directories and maximum number of sub-directories listed
+            self.max_depth = None
+            self.max_directories = None
+            # Number of files reordered at once by schedule_files
+            self.schedule_batch_size = 4096
+
+        @property
+        def drive_name(self):
+            return self._drive_name
+
+        @property
+        def basepath(self):
+            return self._basepath
+
+        @property
+        def raw_device(self):
+            """RawDevice of the drive, the device is opened on the first read"""
+            if self._raw_device is None:
+                self._raw_device = RawDevice(self._drive_name)
+            return self._raw_device
+
+        def enumerate_files(self, directory=None, recurse_callback=None, file_filter=None):
             """
             Enumerates the files from the drive
 
             Args:
                 directory: base directory (default Root of drive)
                 recurse_callback: callback used for recursion control (default None)
+                file_filter: FileFilter checked on the directory entries before building the files (default None)
+
+            :rtype: Iterator[_File]
+            """
+            for basepath in self._get_basepaths(directory):
+                odir = self._open_directory(basepath.as_posix())
+                for item in self._list_directory(
+                        odir,
+                        stack=[],
+                        parent_path=basepath,
+                        recurse_callback=recurse_callback,
+                        file_filter=file_filter):
+                    yield item
+
+        def schedule_files(self, files, batch_size=None):
+            """
+            Order enumerated files for reading, the base drive keeps the enumeration order
+
+            Args:
+                files: iterable of File, usually from enumerate_files
+                batch_size: number of files reordered at once (default self.schedule_batch_size)
+
+            :rtype: Iterator[_File]
+            """
+            return iter(files)
+
+        def enumerate_dirty(self, dirty, file_filter=None):
+            """
+            Enumerates the files of changed directories, see ChangeJournal.pop_dirty
+
+            Args:
+                dirty: list of (directory, recursive), the sub-directories are only listed if recursive is set
+                file_filter: see enumerate_files
 
             :rtype: Iterator[_File]
             """
+            for directory, recursive in dirty:
+                yield from self.enumerate_files(directory, None if recursive else (lambda path: False), file_filter)
+
+        def get_dirty_scope(self, dirty):
+            """Get the scope of FileIndex.diff for the enumeration of changed directories"""
+            return [(basepath, recursive) for directory, recursive in dirty
+                    for basepath in self._get_basepaths(directory)]
+
+        def _get_basepaths(self, directory=None):
+            """Get the paths of the listed directories relative to the root of the drive"""
             if not directory:
                 directory = [self._basepath]
             elif not isinstance(directory, list):
                 directory = [directory]
 
+            basepaths = []
             for d in directory:  # type: str
                 try:
                     # Remove the drive letter for windows if the relative path has no drive letter
-                    cleanbase = self._basepath[2:] if self._basepath[1] == ':' and d[1] != ':' else self._basepath
-                    basepath = Path('/') / Path(d + os.path.sep).relative_to(cleanbase)
+                    cleanbase = self._basepath[2:] if self._basepath[1:2] == ':' and d[1:2] != ':' else self._basepath
+                    basepaths.append(Path('/') / Path(d + os.path.sep).relative_to(cleanbase))
                 except ValueError:
                     # relative_to raises a ValueError is the paths are not relatives
                     continue
-                odir = self._open_directory(basepath.as_posix())
-                for item in self._list_directory(
-                        odir,
-                        stack=[],
-                        parent_path=basepath,
-                        recurse_callback=recurse_callback):
-                    yield item
+            return basepaths
 
         def _open_directory(self, inode_or_path):
             raise NotImplementedError()
 
-        def _list_directory(self, directory, stack=None, parent_path=Path('/'), recurse_callback=None):
+        def _list_directory(self, directory, stack=None, parent_path=Path('/'), recurse_callback=None,
+                            file_filter=None):
             raise NotImplementedError()
 
         def read_disk(self, size, pos=None, pos_mode=os.SEEK_SET):
@@ -167,33 +515,334 @@ class DriveManager(object):
         def _open_directory(self, inode_or_path):
             return str(Path(inode_or_path).relative_to('/'))
 
-        def _list_directory(self, directory, stack=None, parent_path=Path('/'), recurse_callback=None):
+        def _list_directory(self, directory, stack=None, parent_path=Path('/'), recurse_callback=None,
+                            file_filter=None):
             for entry in os.scandir(os.path.join(self._basepath, directory)):
                 try:
                     if entry.is_dir(follow_symlinks=False):
                         if self._recursive:
+                            if file_filter and not file_filter.match_directory(entry.path):
+                                continue
                             if recurse_callback:
                                 try:
                                     if not recurse_callback(Path(entry.path)):
                                         continue
                                 except:
                                     continue
-                        yield from self._list_directory(entry.path, stack, parent_path / entry.path, recurse_callback)
+                        yield from self._list_directory(entry.path, stack, parent_path / entry.path, recurse_callback,
+                                                        file_filter)
                     else:
-                        yield AndroidFile(entry)
+                        if file_filter and not file_filter.match_entry(
+                                entry.name, False, entry.path if file_filter.needs_path else None,
+                                lambda: _stat_meta(entry)):
+                            continue
+                        yield AndroidFile(entry, self.hash_cache, self.pe_cache)
                 except OSError:
                     continue
 
+    class NativeDrive(Drive):
+        """
+        Drive listed with the operating system (os.scandir), used for the mounted file systems libtsk cannot read
+        """
+
+        def __init__(self, drive_name, basepath=None):
+            super(DriveManager.NativeDrive, self).__init__(drive_name, basepath)
+            # Do not cross mount points
+            self.one_filesystem = True
+
+        def read_disk(self, size, pos=None, pos_mode=os.SEEK_SET):
+            raise NotImplementedError()
+
+        def _open_directory(self, inode_or_path):
+            return os.path.join(self._basepath, str(Path(inode_or_path).relative_to('/')))
+
+        def _list_directory(self, directory, stack=None, parent_path=Path('/'), recurse_callback=None,
+                            file_filter=None):
+            """
+            List a folder and its sub-folders
+
+            The tree is walked depth-first with an explicit stack of os.scandir iterators. The type of the
+            entries comes from the directory listing, directories are stat-ed once to check that they are on the
+            same device and not already being listed (bind mounts), the stat result is kept by the file object.
+            With one_filesystem, the mount points below the directory are not entered either: bind mounts of the
+            same file system are listed once from their own mount (see DriveManager.list_volumes).
+
+            Returns:
+                Yields NativeFile
+            """
+            try:
+                root_stat = os.stat(directory)
+                entries = os.scandir(directory)
+            except OSError:
+                return
+            device = root_stat.st_dev
+            mount_points = _mount_points() if self.one_filesystem else set()
+            root_key = (root_stat.st_dev, root_stat.st_ino)
+            ancestors = {root_key}
+            pending = [(entries, parent_path, str(parent_path), root_key, 0)]
+            directory_count = 0
+            needs_path = file_filter is not None and file_filter.needs_path
+
+            try:
+                while pending:
+                    entries, path, path_str, key, depth = pending[-1]
+                    try:
+                        entry = next(entries, None)
+                    except OSError:
+                        entry = None
+                    if entry is None:
+                        _close_scandir(entries)
+                        pending.pop()
+                        ancestors.discard(key)
+                        continue
+
+                    try:
+                        is_directory = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_directory = False
+                    entry_path = _join(path_str, entry.name) if needs_path else None
+                    if file_filter is None or file_filter.match_entry(
+                            entry.name, is_directory, entry_path, lambda: _stat_meta(entry)):
+                        yield NativeFile(self, entry, path)
+
+                    if not self._recursive or not is_directory:
+                        continue
+                    if self.max_depth is not None and depth >= self.max_depth:
+                        continue
+                    if self.max_directories is not None and directory_count >= self.max_directories:
+                        continue
+                    if needs_path and not file_filter.match_directory(entry_path):
+                        continue
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    sub_key = (entry_stat.st_dev, entry_stat.st_ino)
+                    if self.one_filesystem and entry_stat.st_dev != device or sub_key in ancestors:
+                        continue
+                    if mount_points and os.path.normpath(entry.path) in mount_points:
+                        continue
+                    sub_path = path / entry.name
+                    if recurse_callback:
+                        try:
+                            if not recurse_callback(sub_path):
+                                continue
+                        except:
+                            continue
+                    try:
+                        sub_entries = os.scandir(entry.path)
+                    except OSError:
+                        continue
+
+                    directory_count += 1
+                    ancestors.add(sub_key)
+                    pending.append((sub_entries, sub_path, str(sub_path), sub_key, depth + 1))
+            finally:
+                for entries, _, _, _, _ in pending:
+                    _close_scandir(entries)
+
     class TSKDrive(Drive):
         """
         TSK Drive object, used for non-mobile endpoints
         """
 
-        def __init__(self, drive_name, basepath=None):
+        def __init__(self, drive_name, basepath=None, raw_backend=False):
             super(DriveManager.TSKDrive, self).__init__(drive_name, basepath)
             import pytsk3
-            self.__img_info = pytsk3.Img_Info(self._drive_name)
+            if raw_backend:
+                from .rawdevice import RawImgInfo
+                self.__img_info = RawImgInfo(self.raw_device)
+            else:
+                self.__img_info = pytsk3.Img_Info(self._drive_name)
             self._fs_info = pytsk3.FS_Info(self.__img_info)
+            self.block_cache = None
+            # Number of data streams opened with each read mode, 'fallback' counts the failed standard opens
+            self.read_stats = collections.Counter()
+            # 'tree' walks the directories, 'mft' reads the MFT sequentially (NTFS only, 'tree' is used otherwise)
+            self.enumeration_mode = 'tree'
+            # List the deleted MFT entries in 'mft' mode
+            self.include_deleted = False
+            self.__is_mounted = None
+
+        @property
+        def is_mounted(self):
+            """The file system of the drive is mounted at basepath, so its files can be opened with the standard API"""
+            if self.__is_mounted is None:
+                if os.name == 'nt':
+                    # \\.\C: is mounted at C:\, the images keep their name as basepath
+                    self.__is_mounted = self._basepath != self._drive_name and os.path.isdir(self._basepath)
+                else:
+                    self.__is_mounted = DriveManager.get_mount(self._drive_name, self._basepath) is not None
+            return self.__is_mounted
+
+        @property
+        def is_ntfs(self):
+            import pytsk3
+            return int(self._fs_info.info.ftype) & pytsk3.TSK_FS_TYPE_NTFS_DETECT != 0
+
+        def enumerate_files(self, directory=None, recurse_callback=None, file_filter=None):
+            """
+            Enumerates the files from the drive
+
+            Args:
+                directory: base directory (default Root of drive)
+                recurse_callback: callback used for recursion control (default None)
+                file_filter: FileFilter checked on the directory entries before building the files (default None)
+
+            :rtype: Iterator[_File]
+            """
+            if self.enumeration_mode != 'mft' or not self.is_ntfs:
+                yield from super(DriveManager.TSKDrive, self).enumerate_files(directory, recurse_callback,
+                                                                              file_filter)
+                return
+
+            basepaths = self._get_basepaths(directory)
+            if basepaths:
+                yield from self._list_mft(basepaths, recurse_callback, file_filter)
+
+        def schedule_files(self, files, batch_size=None):
+            """
+            Order enumerated files by the physical address of their data
+
+            The files are read by batches, each batch is sorted by the first block of the default data stream so
+            that scans of rotational disks mostly read forward. Files without allocated blocks (resident, empty or
+            directories) come first in their batch.
+
+            Args:
+                files: iterable of TSKFile, usually from enumerate_files
+                batch_size: number of files reordered at once (default self.schedule_batch_size)
+
+            :rtype: Iterator[TSKFile]
+            """
+            files = iter(files)
+            batch_size = batch_size or self.schedule_batch_size
+            while True:
+                batch = list(itertools.islice(files, batch_size))
+                if not batch:
+                    break
+                keys = []
+                for index, myfile in enumerate(batch):
+                    try:
+                        block = myfile.get_first_block()
+                    except IOError:
+                        block = None
+                    keys.append((-1 if block is None else block, index))
+                keys.sort()
+                for _, index in keys:
+                    yield batch[index]
+
+        def _list_mft(self, basepaths, recurse_callback=None, file_filter=None):
+            """
+            List the files below some directories by reading the MFT entries in order
+
+            The paths are rebuilt from the parent references of the $FILE_NAME attributes, only the directories
+            are kept in memory. Entries whose parent comes later in the MFT are listed at the end.
+
+            Returns:
+                Yields File
+            """
+            import pytsk3
+            # Directory inode -> (name, parent inode, sequence, allocated), the paths are computed on demand
+            directories = {NTFS_ROOT_INODE: (None, None, None, True)}
+            paths = {NTFS_ROOT_INODE: Path('/')}
+            allowed = dict()
+            deferred = []
+
+            def get_path(inode, sequence=None):
+                """Path of a directory, None if unknown yet, NTFS_ORPHAN_PATH if it has been reused or is a loop"""
+                chain = []
+                while inode not in paths:
+                    entry = directories.get(inode)
+                    if entry is None:
+                        return None
+                    # The sequence of a MFT entry is incremented when it is freed
+                    if (sequence is not None and sequence != entry[2] and (entry[3] or sequence != entry[2] - 1)
+                            or inode in chain):
+                        return NTFS_ORPHAN_PATH
+                    chain.append(inode)
+                    inode, sequence = entry[1], None
+                path = paths[inode]
+                for inode in reversed(chain):
+                    path = path / directories[inode][0].decode('utf-8', errors='replace')
+                    paths[inode] = path
+                return path
+
+            def is_listed(path):
+                """Check that a directory is one of the listed ones or allowed below one of them"""
+                for basepath in basepaths:
+                    if path == basepath:
+                        return True
+                    if basepath not in path.parents:
+                        continue
+                    if not self._recursive:
+                        return False
+                    # Check recurse_callback for each directory between the base path and the path
+                    parent = basepath
+                    for part in path.relative_to(basepath).parts:
+                        parent = parent / part
+                        if not is_allowed(parent):
+                            return False
+                    return True
+                return False
+
+            def is_allowed(path):
+                if path not in allowed:
+                    if file_filter is not None and not file_filter.match_directory(str(path)):
+                        allowed[path] = False
+                        return False
+                    try:
+                        allowed[path] = bool(recurse_callback(path)) if recurse_callback else True
+                    except:
+                        allowed[path] = False
+                return allowed[path]
+
+            def is_matching(tsk_file, name, parent_path):
+                if file_filter is None:
+                    return True
+                meta = tsk_file.info.meta
+                entry_path = _join(str(parent_path), name.decode('utf-8', errors='replace'))
+                return file_filter.match_entry(
+                    name, meta.type == pytsk3.TSK_FS_META_TYPE_DIR, entry_path if file_filter.needs_path else None,
+                    lambda: (meta.size, meta.mtime))
+
+            def make_file(tsk_file, name, parent_path):
+                meta = tsk_file.info.meta
+                name_type = (pytsk3.TSK_FS_NAME_TYPE_DIR if meta.type == pytsk3.TSK_FS_META_TYPE_DIR
+                             else pytsk3.TSK_FS_NAME_TYPE_REG)
+                flags = (pytsk3.TSK_FS_NAME_FLAG_ALLOC if int(meta.flags) & pytsk3.TSK_FS_META_FLAG_ALLOC
+                         else pytsk3.TSK_FS_NAME_FLAG_UNALLOC)
+                return TSKFile(self, _MFTEntry(tsk_file, _MFTName(name, name_type, flags)), parent_path)
+
+            for inode in range(self._fs_info.info.first_inum, self._fs_info.info.last_inum + 1):
+                if inode == NTFS_ROOT_INODE:
+                    continue
+                try:
+                    tsk_file = self._fs_info.open_meta(inode=inode)
+                except IOError:
+                    continue
+                meta = tsk_file.info.meta
+                if meta is None:
+                    continue
+                allocated = int(meta.flags) & pytsk3.TSK_FS_META_FLAG_ALLOC != 0
+                if not allocated and not self.include_deleted:
+                    continue
+                file_name = _ntfs_file_name(tsk_file)
+                if file_name is None:
+                    continue
+                name, parent, sequence = file_name
+                if meta.type == pytsk3.TSK_FS_META_TYPE_DIR:
+                    directories[inode] = (name, parent, meta.seq, allocated)
+
+                parent_path = get_path(parent, sequence)
+                if parent_path is None:
+                    deferred.append((tsk_file, name, parent, sequence))
+                elif is_listed(parent_path) and is_matching(tsk_file, name, parent_path):
+                    yield make_file(tsk_file, name, parent_path)
+
+            for tsk_file, name, parent, sequence in deferred:
+                parent_path = get_path(parent, sequence) or NTFS_ORPHAN_PATH
+                if is_listed(parent_path) and is_matching(tsk_file, name, parent_path):
+                    yield make_file(tsk_file, name, parent_path)
 
         def _open_directory(self, inode_or_path):
             """Open a directory"""
@@ -217,16 +866,36 @@ class DriveManager(object):
 
             return directory
 
-        def _list_directory(self, directory, stack=None, parent_path=Path('/'), recurse_callback=None):
+        def _list_directory(self, directory, stack=None, parent_path=Path('/'), recurse_callback=None,
+                            file_filter=None):
             """
-            List a previously opened folder
+            List a previously opened folder and its sub-folders
+
+            The tree is walked depth-first with an explicit stack of directory iterators, so the depth is not
+            limited by the recursion limit and files are not passed up through a generator per level.
+            The inodes of the directories being listed are kept in a set to detect loops.
+            The file filter is checked on the raw names and metadata, the files are only built for the matching
+            entries and the excluded directories are not opened.
 
             Returns:
                 Yields File
             """
-            stack.append(directory.info.fs_file.meta.addr)
+            import pytsk3
+            ancestors = set(stack or [])
+            root_inode = directory.info.fs_file.meta.addr
+            ancestors.add(root_inode)
+            pending = [(iter(directory), parent_path, str(parent_path), root_inode, 0)]
+            directory_count = 0
+            needs_path = file_filter is not None and file_filter.needs_path
+
+            while pending:
+                entries, path, path_str, inode, depth = pending[-1]
+                directory_entry = next(entries, None)
+                if directory_entry is None:
+                    pending.pop()
+                    ancestors.discard(inode)
+                    continue
 
-            for directory_entry in directory:
                 # Skip ".", ".." or directory entries without a name.
                 if (not hasattr(directory_entry, "info") or
                         not hasattr(directory_entry.info, "name") or
@@ -234,34 +903,43 @@ class DriveManager(object):
                             directory_entry.info.name.name in [".", "..", b".", b".."]):
                     continue
 
-                myfile = TSKFile(self, directory_entry, parent_path)
-                yield myfile
+                name = directory_entry.info.name
+                meta = directory_entry.info.meta
+                entry_path = _join(path_str, name.name.decode('utf-8', errors='replace')) if needs_path else None
+                if file_filter is None or file_filter.match_entry(
+                        name.name, name.type == pytsk3.TSK_FS_NAME_TYPE_DIR, entry_path,
+                        lambda: (meta.size, meta.mtime) if meta is not None else (None, None)):
+                    yield TSKFile(self, directory_entry, path)
 
-                if self._recursive:
-                    if recurse_callback:
-                        try:
-                            if not recurse_callback(myfile.path):
-                                continue
-                        except:
-                            continue
+                if not self._recursive:
+                    continue
+                if meta is None or meta.type != pytsk3.TSK_FS_META_TYPE_DIR:
+                    continue
+                if self.max_depth is not None and depth >= self.max_depth:
+                    continue
+                if self.max_directories is not None and directory_count >= self.max_directories:
+                    continue
+                # This ensures that we don't recurse into a directory
+                # above the current level and thus avoid circular loops.
+                if meta.addr in ancestors:
+                    continue
+                if needs_path and not file_filter.match_directory(entry_path):
+                    continue
+                sub_path = path / name.name.decode('utf-8', errors='replace')
+                if recurse_callback:
                     try:
-                        sub_directory = directory_entry.as_directory()
-                        inode = directory_entry.info.meta.addr
-
-                        # This ensures that we don't recurse into a directory
-                        # above the current level and thus avoid circular loops.
-                        if inode not in stack:
-                            for item in self._list_directory(
-                                    sub_directory,
-                                    stack=stack,
-                                    parent_path=myfile.path,
-                                    recurse_callback=recurse_callback):
-                                yield item
-
-                    except IOError:
-                        pass
+                        if not recurse_callback(sub_path):
+                            continue
+                    except:
+                        continue
+                try:
+                    sub_directory = directory_entry.as_directory()
+                except IOError:
+                    continue
 
-            stack.pop(-1)
+                directory_count += 1
+                ancestors.add(meta.addr)
+                pending.append((iter(sub_directory), sub_path, str(sub_path), meta.addr, depth + 1))
 
         def read_disk(self, size, pos=None, pos_mode=os.SEEK_SET):
             """
@@ -276,6 +954,23 @@ class DriveManager(object):
                 a bytes object
             """
             if pos is not None:
-                os.lseek(self.drive_fd, pos, pos_mode)
-            data = os.read(self.drive_fd, size)
+                if pos_mode == os.SEEK_CUR:
+                    pos += self._disk_pos
+                elif pos_mode == os.SEEK_END:
+                    pos += self.raw_device.get_size()
+                self._disk_pos = pos
+            data = self.raw_device.read(self._disk_pos, size)
+            self._disk_pos += len(data)
             return data
+
+        def read_disk_extents(self, extents):
+            """
+            Read several ranges of the disk at once, see RawDevice.read_extents
+
+            Args:
+                extents: list of (offset, length)
+
+            Returns:
+                list of bytes, in the order of extents
+            """
+            return self.raw_device.read_extents(extents)
@@ -18,17 +18,28 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
-import array
+import collections
+import errno
 import hashlib
 import io
+import itertools
 import logging
 import math
+import mmap
 import numbers
 import os
+import queue
+import random
+import stat
+import struct
+import sys
+import threading
 import yara
-from functools import partial
 from pathlib import Path
 
+from .filetype import SNIFF_SIZE, category, sniff
+from .pe import parse_pe_headers
+
 try:
     import pytsk3
 
@@ -43,6 +54,13 @@ try:
 except ImportError:
     PEFILE_SUPPORT = False
     pass
+try:
+    import numpy
+
+    NUMPY_SUPPORT = True
+except ImportError:
+    NUMPY_SUPPORT = False
+    pass
 
 
 def old_div(a, b):
@@ -58,17 +76,285 @@ def old_div(a, b):
         return a / b
 
 
+def _count_bytes_numpy(data):
+    """Count the occurences of each byte value using numpy"""
+    return numpy.bincount(numpy.frombuffer(data, dtype=numpy.uint8), minlength=256).tolist()
+
+
+def _count_bytes_python(data):
+    """Count the occurences of each byte value (pure python fallback)"""
+    counter = collections.Counter(data)
+    return [counter[item] for item in range(256)]
+
+
+def _digest_worker(digester, chunks, errors):
+    """
+    Feed a digester with the chunks of a queue until the None end marker
+
+    An exception of the digester is appended to errors and the queue is still drained, so the reader never blocks
+    on a full queue.
+    """
+    for buf in iter(chunks.get, None):
+        if errors:
+            continue
+        try:
+            digester.update(buf)
+        except Exception as err:
+            errors.append(err)
+
+
+def _iter_windows(data_file, size, window_size, overlap=0):
+    """
+    Read up to size bytes of a file object as successive windows of window_size bytes
+
+    Each window starts with the last overlap bytes of the previous one so patterns crossing a window
+    boundary are still seen in full. The windows are memoryviews of a single reused buffer, they are only
+    valid until the next window is requested.
+    """
+    buf = bytearray(window_size)
+    view = memoryview(buf)
+    length = 0
+    remaining = size
+    while remaining > 0:
+        tail = length
+        while length < window_size and remaining > 0:
+            read = data_file.readinto(view[length:min(window_size, length + remaining)])
+            if not read:
+                remaining = 0
+                break
+            length += read
+            remaining -= read
+        if length == tail:
+            break
+        yield view[:length]
+        keep = min(overlap, length)
+        buf[:keep] = buf[length - keep:length]
+        length = keep
+
+
+def _triage_hash(view, block_size):
+    """
+    Hash the size and the first, middle and last block_size bytes of a FileView
+
+    Files of up to three blocks are hashed entirely.
+
+    Returns:
+        tuple (size, SHA-256 hex-digest)
+    """
+    size = len(view)
+    digest = hashlib.sha256(struct.pack('<Q', size))
+    if size <= 3 * block_size:
+        ranges = [(0, size)]
+    else:
+        ranges = [(0, block_size), ((size - block_size) // 2, block_size), (size - block_size, block_size)]
+    for offset, length in ranges:
+        digest.update(view[offset:offset + length])
+    return size, digest.hexdigest()
+
+
+class TriageWatchList(object):
+    """Sizes and triage hashes of the samples for which a full hash is needed"""
+
+    def __init__(self, sizes=None, triage_hashes=None):
+        self.sizes = set(sizes or [])
+        self.triage_hashes = set(triage_hashes or [])
+
+    def add(self, size=None, triage_hash=None):
+        """Watch a sample by size and / or triage hash"""
+        if size is not None:
+            self.sizes.add(size)
+        if triage_hash is not None:
+            self.triage_hashes.add(triage_hash)
+
+    def matches(self, size, triage_hash):
+        """Returns if a file with this size and triage hash could be a watched sample"""
+        return size in self.sizes or triage_hash in self.triage_hashes
+
+
+def _map_file(data_file):
+    """Memory-map a file object read-only, returns None for special files and sizes which cannot be mapped"""
+    try:
+        fileno = data_file.fileno()
+        file_stat = os.fstat(fileno)
+    except (AttributeError, OSError, ValueError):
+        # io.UnsupportedOperation is both an OSError and a ValueError
+        return None
+    if not stat.S_ISREG(file_stat.st_mode) or not 0 < file_stat.st_size <= sys.maxsize:
+        return None
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, OverflowError):
+        return None
+
+
+class FileView(object):
+    """
+    Read-only random access to a data stream
+
+    Regular files are memory-mapped and slicing returns memoryviews of the mapping, without any copy. Other file
+    objects (TSKData, special files, files which cannot be mapped) are read with seek / read, unless they are
+    loaded in memory with load().
+    """
+
+    def __init__(self, data_file):
+        self.__file = data_file
+        self.__mmap = _map_file(data_file)
+        if self.__mmap is not None:
+            self.__view = memoryview(self.__mmap)
+            self.size = len(self.__mmap)
+        else:
+            self.__view = None
+            self.size = data_file.seek(0, io.SEEK_END)
+
+    @property
+    def mapped(self):
+        """Returns if the data is memory-mapped or loaded in memory"""
+        return self.__view is not None
+
+    def load(self, max_size):
+        """
+        Read unmapped data of at most max_size bytes in memory, the next reads are then served without I/O
+
+        Returns:
+            bool, the data is mapped or loaded
+        """
+        if self.__view is None and self.size <= max_size:
+            self.__file.seek(0)
+            data = self.__file.read(self.size)
+            self.__view = memoryview(data)
+            self.size = len(data)
+        return self.__view is not None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError("FileView only supports slicing")
+        if self.__view is not None:
+            return self.__view[item]
+        start, stop, step = item.indices(self.size)
+        if step != 1:
+            raise ValueError("FileView does not support extended slicing")
+        self.__file.seek(start)
+        return self.__file.read(max(0, stop - start))
+
+    def iter_chunks(self, chunk_size, ring_size=1):
+        """
+        Yield the data as memoryviews of at most chunk_size bytes
+
+        Unmapped data is read in a ring of ring_size reused buffers, a chunk is only valid until ring_size more
+        chunks have been requested.
+        """
+        if self.__view is not None:
+            for offset in range(0, self.size, chunk_size):
+                yield self.__view[offset:offset + chunk_size]
+            return
+
+        self.__file.seek(0)
+        ring = [memoryview(bytearray(chunk_size)) for _ in range(ring_size)]
+        for index in itertools.count():
+            view = ring[index % ring_size]
+            read = self.__file.readinto(view)
+            if not read:
+                return
+            yield view[:read]
+
+    def iter_windows(self, size, window_size, overlap=0):
+        """
+        Yield the first size bytes as overlapping windows, see _iter_windows
+
+        Mapped data is not copied and is returned as a single window.
+        """
+        if self.__view is not None:
+            yield self.__view[:size]
+            return
+        self.__file.seek(0)
+        yield from _iter_windows(self.__file, size, window_size, overlap)
+
+    def close(self):
+        """Close the view and the underlying file object"""
+        if self.__view is not None:
+            self.__view.release()
+            self.__view = None
+        if self.__mmap is not None:
+            try:
+                self.__mmap.close()
+            except BufferError:
+                # Some slices are still referenced, the mapping is closed when they are released
+                pass
+            self.__mmap = None
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CachedHash(object):
+    """Hash result restored from a cache, exposes the read-only part of the hashlib API"""
+
+    def __init__(self, name, hexdigest):
+        self.name = name
+        self.__hexdigest = hexdigest
+
+    def digest(self):
+        return bytes.fromhex(self.__hexdigest)
+
+    def hexdigest(self):
+        return self.__hexdigest
+
+
+class WindowMatch(object):
+    """
+    yara.Match found in a window of a stream, see _File.scan_yara
+
+    The attributes of the match are evaluated against the window: the string offsets are relative to
+    window_offset, the offset of the window in the stream.
+    """
+
+    def __init__(self, match, window_offset):
+        self.match = match
+        self.window_offset = window_offset
+
+    def __getattr__(self, item):
+        return getattr(self.match, item)
+
+    def __repr__(self):
+        return '{}@{}'.format(self.match, self.window_offset)
+
+
 class EntropyCompute(object):
     """Get the entropy of some data"""
 
     def __init__(self):
-        self.__occurences = array.array('L', [0] * 256)
+        self.__occurences = [0] * 256
         self.__data_count = 0
+        self.__count_bytes = _count_bytes_numpy if NUMPY_SUPPORT else _count_bytes_python
+
+    @classmethod
+    def from_histogram(cls, histogram):
+        """Restore an EntropyCompute from a byte histogram"""
+        entropy = cls()
+        entropy.__occurences = list(histogram)
+        entropy.__data_count = sum(entropy.__occurences)
+        return entropy
 
     def update(self, data):
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        data = memoryview(data).cast('B')
+        if not data:
+            return
         self.__data_count += len(data)
-        for item in data:
-            self.__occurences[item if isinstance(item, int) else ord(item)] += 1
+        counts = self.__count_bytes(data)
+        self.__occurences = [occ + count for occ, count in zip(self.__occurences, counts)]
+
+    def get_histogram(self):
+        """Return the number of occurences of each byte value"""
+        return list(self.__occurences)
 
     def get_entropy(self):
         entropy = 0
@@ -79,22 +365,101 @@ class EntropyCompute(object):
         return entropy
 
 
+EntropyEstimate = collections.namedtuple('EntropyEstimate', ['entropy', 'error', 'samples', 'exact'])
+
+
+def _histogram_entropy(histogram):
+    """Entropy in bits per byte of a byte histogram"""
+    total = sum(histogram)
+    entropy = 0.0
+    for occ in histogram:
+        if occ:
+            p_x = occ / total
+            entropy -= p_x * math.log(p_x, 2)
+    return entropy
+
+
+def estimate_entropy(data_file, budget=4 * 1024 * 1024, block_size=64 * 1024, z=1.96, seed=None):
+    """
+    Estimate the entropy of a seekable file object from randomly placed blocks
+
+    The file is split in budget // block_size strata and one block is read at a random offset in each of them.
+    The estimate is the entropy of the pooled blocks, the error is the half-width of the confidence interval of
+    that same estimator, from its jackknife variance (the pooled entropy recomputed without each block, z=1.96
+    for 95%). Files smaller than the budget are read entirely and their entropy is exact.
+
+    Returns:
+        EntropyEstimate
+    """
+    size = data_file.seek(0, io.SEEK_END)
+    if size <= budget:
+        entropy = EntropyCompute()
+        data_file.seek(0)
+        for buf in iter(lambda: data_file.read(block_size), b''):
+            entropy.update(buf)
+        return EntropyEstimate(entropy.get_entropy(), 0.0, 1, True)
+
+    count = max(1, budget // block_size)
+    stratum = (size - block_size) / count
+    rand = random.Random(seed)
+    pooled = EntropyCompute()
+    histograms = []
+    sampled = 0
+    for index in range(count):
+        data_file.seek(int(index * stratum + rand.random() * stratum))
+        buf = data_file.read(block_size)
+        if not buf:
+            continue
+        block = EntropyCompute()
+        block.update(buf)
+        pooled.update(buf)
+        histograms.append(block.get_histogram())
+        sampled += len(buf)
+
+    estimate = pooled.get_entropy()
+    samples = len(histograms)
+    if samples < 2:
+        return EntropyEstimate(estimate, 8.0, samples, False)
+    histogram = pooled.get_histogram()
+    replicates = [_histogram_entropy([total - occ for total, occ in zip(histogram, block)]) for block in histograms]
+    mean = sum(replicates) / samples
+    variance = (samples - 1) / samples * sum((replicate - mean) ** 2 for replicate in replicates)
+    # Finite population correction: the samples cover a part of the file
+    correction = math.sqrt(max(0.0, 1 - sampled / size))
+    error = z * math.sqrt(variance) * correction
+    return EntropyEstimate(estimate, error, samples, False)
+
+
 class _File(object):
     """
     Generic file object
     Must be specialized
     """
+    __slots__ = ('_hashes', 'read_mode', 'digests', 'parallel', 'hash_cache', 'pe_cache', '__weakref__')
+
     HASH_TYPES = dict(
         md5=hashlib.md5,
         sha1=hashlib.sha1,
         sha256=hashlib.sha256,
         sha512=hashlib.sha512,
     )
+    DIGEST_TYPES = ('entropy', 'histogram', 'size', 'triage', 'filetype')
+    TRIAGE_BLOCK_SIZE = 64 * 1024
+    PE_EXTENSIONS = ('.dll', '.exe', '.sys')
     BUF_SIZE = 1024 * 1024
+    PARALLEL_QUEUE_SIZE = 8
+    YARA_WINDOW_THRESHOLD = 64 * 1024 * 1024
+    YARA_WINDOW_SIZE = 16 * 1024 * 1024
+    YARA_WINDOW_OVERLAP = 1024 * 1024
+    YARA_MAX_SCAN_BYTES = None
 
     def __init__(self):
         self._hashes = dict()
         self.read_mode = 'raw'
+        self.digests = tuple(self.HASH_TYPES.keys())
+        self.parallel = False
+        self.hash_cache = None
+        self.pe_cache = None
 
     def get_data(self, name=None, mode=None):
         """
@@ -114,74 +479,577 @@ class _File(object):
         """Return if a file is deleted"""
         return False
 
-    def get_hashes(self, name):
-        if name in self._hashes:
-            return self._hashes[name]
+    def _cache_key(self, name):
+        """
+        Return the key identifying the content of a data stream in the persistent caches
+
+        Args:
+            name: None or the name of the data stream
+
+        Returns:
+            str
+            None if the stream cannot be cached
+        """
+        return None
+
+    def get_hashes(self, name, digests=None):
+        """
+        Compute the requested digests of a data stream in a single read pass
+
+        Digests already computed for the stream are reused, the data is only read if one of the requested
+        digests is missing, and digests which are not requested are not computed at all.
+        When self.parallel is set, each digest is computed by its own thread.
+        When self.hash_cache is set, it is consulted before reading any data and updated afterwards.
+        The 'triage' digest (see get_triage_hash) only reads a few blocks of the stream and gives its size, the
+        'filetype' (see get_filetype) only reads the first block.
+
+        Args:
+            name: None or the name of the data stream
+            digests: names of the digests to compute, any of HASH_TYPES and DIGEST_TYPES (default self.digests)
+
+        Returns:
+            dict of the requested digests only: hash objects, EntropyCompute ('entropy'), size in bytes ('size',
+            also given with 'triage'), triage hex-digest ('triage') and file type ('filetype')
+            None
+        """
+        return self._get_hashes(name, digests)
+
+    def _get_hashes(self, name, digests=None, view=None):
+        """get_hashes reading an already open FileView of the stream (left open) instead of opening it"""
+        wanted = set(self.digests if digests is None else digests)
+        if 'histogram' in wanted:
+            # The histogram is a by-product of the entropy computation
+            wanted.discard('histogram')
+            wanted.add('entropy')
+        unknown = wanted - set(self.HASH_TYPES) - set(self.DIGEST_TYPES)
+        if unknown:
+            raise ValueError("Unknown digest types: {}".format(', '.join(sorted(unknown))))
+
+        hashes = self._hashes.get(name, dict())
+        missing = wanted - set(hashes)
+        if not missing:
+            return self.__select(hashes, wanted)
+
+        cache_key = self._cache_key(name) if self.hash_cache is not None else None
+        if cache_key:
+            hashes.update(self.__load_cached_hashes(cache_key))
+            self._hashes[name] = hashes
+            missing = wanted - set(hashes)
+            if not missing:
+                return self.__select(hashes, wanted)
+
+        owned = view is None
+        if owned:
+            view = self.get_view(name)
+            if view is None:
+                return None
+        try:
+            if missing & {'triage', 'filetype'}:
+                if 'filetype' in missing:
+                    hashes['filetype'] = sniff(bytes(view[0:SNIFF_SIZE]))
+                if 'triage' in missing:
+                    hashes['size'], hashes['triage'] = _triage_hash(view, self.TRIAGE_BLOCK_SIZE)
+                self._hashes[name] = hashes
+                missing = wanted - set(hashes)
+            if missing:
+                self.__digest_view(view, hashes, missing)
+        finally:
+            if owned:
+                view.close()
+
+        self._hashes[name] = hashes
+        if cache_key:
+            self.__store_cached_hashes(cache_key, hashes)
+        return self.__select(hashes, wanted)
 
+    @staticmethod
+    def __select(hashes, wanted):
+        """
+        Copy the requested digests of the stream, the size comes with the triage hash
+
+        The digests of the stream computed by earlier calls are kept in self._hashes but not returned, so the
+        result does not depend on the getters called before.
+        """
+        if 'triage' in wanted:
+            wanted = wanted | {'size'}
+        return {digest: value for digest, value in hashes.items() if digest in wanted}
+
+    def __digest_view(self, view, hashes, missing):
+        """Compute the missing hashes and entropy in a single pass over the view"""
+        digesters = dict()
+        for digest in missing:
+            if digest in self.HASH_TYPES:
+                digesters[digest] = self.HASH_TYPES[digest]()
+            elif digest == 'entropy':
+                digesters[digest] = EntropyCompute()
+
+        if self.parallel and len(digesters) > 1:
+            size = self.__digest_parallel(view, digesters)
+        else:
+            size = self.__digest(view.iter_chunks(self.BUF_SIZE), digesters)
+        hashes.update(digesters)
+        if 'size' in missing:
+            hashes['size'] = size
+
+    def __load_cached_hashes(self, cache_key):
+        """Restore the digests stored in the hash cache"""
+        return self.import_hashes(self.hash_cache.get(cache_key) or dict())
+
+    def __store_cached_hashes(self, cache_key, hashes):
+        """Store the computed digests in the hash cache"""
+        self.hash_cache.set(cache_key, self.export_hashes(hashes))
+
+    @classmethod
+    def export_hashes(cls, hashes):
+        """Convert the digests returned by get_hashes to JSON serializable values"""
+        exported = dict()
+        for digest, value in hashes.items():
+            if digest in cls.HASH_TYPES:
+                exported[digest] = value.hexdigest()
+            elif digest == 'entropy':
+                exported[digest] = value.get_histogram()
+            else:
+                exported[digest] = value
+        return exported
+
+    @classmethod
+    def import_hashes(cls, exported):
+        """Restore the digests converted by export_hashes"""
+        hashes = dict()
+        for digest, value in exported.items():
+            if digest in cls.HASH_TYPES:
+                hashes[digest] = CachedHash(digest, value)
+            elif digest == 'entropy':
+                hashes[digest] = EntropyCompute.from_histogram(value)
+            else:
+                hashes[digest] = value
+        return hashes
+
+    def __digest(self, chunks, digesters):
+        """Feed the digesters with the data chunks, returns the number of bytes read"""
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            for digester in digesters.values():
+                digester.update(chunk)
+        return size
+
+    def __digest_parallel(self, view, digesters):
+        """
+        Feed the digesters with the data, returns the number of bytes read
+
+        The current thread only reads the data and hands the chunks to one worker thread per digester through
+        bounded queues. hashlib releases the GIL while hashing large buffers so the digests are computed on
+        several cores and the reads become the bottleneck.
+
+        Unmapped data is read in a ring of reused buffers: a worker holds at most one chunk while its queue holds
+        PARALLEL_QUEUE_SIZE more and the reader fills the next one, so a buffer is never overwritten while in use.
+        """
+        workers = []
+        errors = []
+        for digester in digesters.values():
+            chunks = queue.Queue(maxsize=self.PARALLEL_QUEUE_SIZE)
+            worker = threading.Thread(target=_digest_worker, args=(digester, chunks, errors), daemon=True)
+            worker.start()
+            workers.append((worker, chunks))
+
+        size = 0
+        try:
+            for chunk in view.iter_chunks(self.BUF_SIZE, self.PARALLEL_QUEUE_SIZE + 2):
+                if errors:
+                    break
+                size += len(chunk)
+                for _, chunks in workers:
+                    chunks.put(chunk)
+        finally:
+            for worker, chunks in workers:
+                chunks.put(None)
+                worker.join()
+        if errors:
+            # Raised in the reader so that a failing digester is an error and not a hang
+            raise errors[0]
+        return size
+
+    def get_view(self, name=None):
+        """
+        Return a read-only view of a data stream, memory-mapped when possible
+
+        Args:
+            name: None or the name of the data stream
+
+        Returns:
+            FileView
+            None
+        """
         data_file = self.get_data(name, self.read_mode)
         if not data_file:
             return None
+        return FileView(data_file)
 
-        try:
-            self._hashes[name] = dict()
-            for hash_type, hash_class in self.HASH_TYPES.items():
-                self._hashes[name][hash_type] = hash_class()
-
-            for buf in iter(partial(data_file.read, self.BUF_SIZE), b''):
-                for hash_type in self.HASH_TYPES.keys():
-                    self._hashes[name][hash_type].update(buf)
-            return self._hashes[name]
-        finally:
-            data_file.close()
+    def __get_digest(self, name, digest):
+        """Get a single digest, computing it along with the default digests if needed"""
+        hashes = self.get_hashes(name, set(self.digests) | {digest})
+        if hashes:
+            return hashes.get(digest)
+        return None
 
     def get_hash_md5(self, name=None):
         """Get the MD5 hex-digest of the file."""
-        hashes = self.get_hashes(name)
-        if hashes and hashes.get('md5'):
-            return hashes.get('md5').hexdigest()
+        digest = self.__get_digest(name, 'md5')
+        if digest:
+            return digest.hexdigest()
         return None
 
     def get_hash_sha1(self, name=None):
         """Get the SHA-1 hex-digest of the file."""
-        hashes = self.get_hashes(name)
-        if hashes and hashes.get('sha1'):
-            return hashes.get('sha1').hexdigest()
+        digest = self.__get_digest(name, 'sha1')
+        if digest:
+            return digest.hexdigest()
         return None
 
     def get_hash_sha256(self, name=None):
         """Get the SHA-256 hex-digest of the file."""
-        hashes = self.get_hashes(name)
-        if hashes and hashes.get('sha256'):
-            return hashes.get('sha256').hexdigest()
+        digest = self.__get_digest(name, 'sha256')
+        if digest:
+            return digest.hexdigest()
         return None
 
     def get_hash_sha512(self, name=None):
         """Get the SHA-512 hex-digest of the file."""
-        hashes = self.get_hashes(name)
-        if hashes and hashes.get('sha512'):
-            return hashes.get('sha512').hexdigest()
+        digest = self.__get_digest(name, 'sha512')
+        if digest:
+            return digest.hexdigest()
+        return None
+
+    def get_triage_hash(self, name=None):
+        """
+        Get the triage hex-digest of the file: SHA-256 of its size and of its first, middle and last
+        TRIAGE_BLOCK_SIZE bytes. Only a few hundred KB are read whatever the size of the file.
+        """
+        hashes = self.get_hashes(name, ['triage'])
+        if hashes:
+            return hashes.get('triage')
+        return None
+
+    def get_filetype(self, name=None):
+        """
+        Get the type of the file from its first block, see epclib.filesystem.filetype
+
+        Returns:
+            str
+            None
+        """
+        hashes = self.get_hashes(name, ['filetype'])
+        if hashes:
+            return hashes.get('filetype')
         return None
 
+    def get_hashes_if_watched(self, watch_list, name=None, digests=None):
+        """
+        Compute the digests of a data stream only if its size or its triage hash is in a watch list
+
+        Args:
+            watch_list: TriageWatchList
+            name: None or the name of the data stream
+            digests: names of the digests to compute (default self.digests)
+
+        Returns:
+            see get_hashes
+            None if the stream does not match the watch list
+        """
+        hashes = self.get_hashes(name, ['triage'])
+        if not hashes or not watch_list.matches(hashes['size'], hashes['triage']):
+            return None
+        return self.get_hashes(name, digests)
+
     def get_entropy(self, name=None):
         """Calculate and return the entropy for the file."""
-        hashes = self.get_hashes(name)
-        if hashes and hashes.get('entropy'):
-            return hashes.get('entropy').get_entropy()
+        digest = self.__get_digest(name, 'entropy')
+        if digest:
+            return digest.get_entropy()
+        return None
+
+    def get_entropy_estimate(self, name=None, budget=4 * 1024 * 1024, block_size=64 * 1024):
+        """
+        Estimate the entropy for the file by reading at most budget bytes, see estimate_entropy
+
+        Returns:
+            EntropyEstimate
+            None
+        """
+        data_file = self.get_data(name, self.read_mode)
+        if not data_file:
+            return None
+        try:
+            return estimate_entropy(data_file, budget, block_size)
+        finally:
+            data_file.close()
+
+    def get_histogram(self, name=None):
+        """Calculate and return the byte histogram for the file."""
+        digest = self.__get_digest(name, 'entropy')
+        if digest:
+            return digest.get_histogram()
         return None
 
-    def scan_yara(self, rules, ads=None, fast=False):
-        """Scan the file using yara rules"""
-        raise NotImplementedError()
+    def get_pe_metadata(self, force=False):
+        """
+        Returns the PE metadata read from the headers, see epclib.filesystem.pe.parse_pe_headers
+
+        The metadata is stored in self.pe_cache when set, so unchanged files are not read again.
+
+        Args:
+            force: Disable the extension and file type detection of PE files (default False)
+
+        Returns:
+            dict
+            None
+        """
+        if not force and self.path.suffix.lower() not in self.PE_EXTENSIONS and self.get_filetype() != 'pe':
+            return None
+
+        cache_key = self._cache_key(None) if self.pe_cache is not None else None
+        if cache_key:
+            metadata = self.pe_cache.get(cache_key)
+            if metadata is not None:
+                return metadata or None
+
+        data_file = self.get_data(None, self.read_mode)
+        if not data_file:
+            return None
+        try:
+            metadata = parse_pe_headers(data_file)
+        except (OSError, ValueError):
+            metadata = None
+        finally:
+            data_file.close()
+
+        if cache_key:
+            # Files which are not PE are cached as an empty dict
+            self.pe_cache.set(cache_key, metadata or dict())
+        return metadata
+
+    def data_streams(self):
+        """Names of the data streams of the file"""
+        return list(self.streams)
+
+    def scan_streams(self, digests=None, rules=None, fast=False, max_bytes=None, skip_types=None):
+        """
+        Digest and / or scan every data stream of the file (default stream and alternate data streams)
+
+        Each stream is opened once. When scanning, the digests and the md5 and file type used as yara externals are
+        computed from the data read for yara: streams of at most YARA_WINDOW_THRESHOLD bytes are read once in
+        memory, larger unmapped streams are read once for the digests and once for the windowed scan.
+
+        Args:
+            digests: names of the digests to compute, see get_hashes (default self.digests)
+            rules: yara rules, see scan_yara (default None: no scan)
+            fast, max_bytes, skip_types: see scan_yara
+
+        Returns:
+            dict of stream name -> dict(hashes=..., matches=...)
+        """
+        wanted = set(self.digests if digests is None else digests)
+        if rules is not None:
+            wanted |= {'md5', 'filetype'}
+        results = dict()
+        for name in self.data_streams():
+            ads = None if name == '$Data' else name
+            if rules is None:
+                results[name] = dict(hashes=self.get_hashes(ads, wanted))
+                continue
+            view = self.get_view(ads)
+            if view is None:
+                results[name] = dict(hashes=None, matches=[])
+                continue
+            try:
+                matches = self._scan_view(rules, ads, view, fast, max_bytes, skip_types, wanted)
+                results[name] = dict(hashes=self._get_hashes(ads, wanted, view), matches=matches)
+            finally:
+                view.close()
+        return results
+
+    def scan_yara(self, rules, ads=None, fast=False, max_bytes=None, skip_types=None):
+        """
+        Scan the file using yara rules
+
+        The stream is read once and the data is shared by all the rules. Memory-mapped files are matched directly
+        against the mapping, other streams larger than YARA_WINDOW_THRESHOLD are scanned in overlapping windows of
+        YARA_WINDOW_SIZE bytes to bound the memory usage, each matching rule is then reported once.
+
+        Each window is matched as if it was a whole file: filesize, the anchored conditions (uint16(0) == 0x5A4D,
+        $a at 0...) and the string offsets are evaluated against the window, not the stream. Such rules can miss
+        past the first window, and only strings shorter than YARA_WINDOW_OVERLAP are seen across the window
+        boundaries. The matches of a windowed scan are returned as WindowMatch, with the stream offset of their
+        window.
+
+        Args:
+            rules: compiled yara rules or YaraRuleset, or a list of them
+            ads: None or the name of the data stream
+            fast: stop at the first match of each string
+            max_bytes: maximum number of bytes to scan (default YARA_MAX_SCAN_BYTES, None scans everything)
+            skip_types: file types or categories (see epclib.filesystem.filetype) which are not scanned
+
+        Returns:
+            list of yara.Match, or WindowMatch for a windowed scan
+        """
+        if not self.streams.get(ads or '$Data'):
+            return []
+        view = self.get_view(ads)
+        if view is None:
+            return []
+        try:
+            return self._scan_view(rules, ads, view, fast, max_bytes, skip_types)
+        finally:
+            view.close()
+
+    def _scan_view(self, rules, ads, view, fast=False, max_bytes=None, skip_types=None, digests=('md5',)):
+        """
+        scan_yara reading an already open FileView of the stream (left open)
+
+        Streams of at most YARA_WINDOW_THRESHOLD bytes are loaded in memory (after checking the file type with
+        skip_types), the file type, the md5 external and the other digests are then computed from the same data
+        as the scan.
+
+        Args:
+            digests: digests computed in the same pass as the md5 external, see get_hashes
+        """
+        stream = self.streams.get(ads or '$Data')
+        if not stream:
+            return []
+        if not isinstance(rules, (list, tuple)):
+            rules = [rules]
+        if max_bytes is None:
+            max_bytes = self.YARA_MAX_SCAN_BYTES
+        size = stream['size'] if max_bytes is None else min(stream['size'], max_bytes)
+        if size > self.YARA_WINDOW_THRESHOLD:
+            window_size, overlap = self.YARA_WINDOW_SIZE, self.YARA_WINDOW_OVERLAP
+        else:
+            window_size, overlap = size, 0
+
+        if not skip_types:
+            view.load(self.YARA_WINDOW_THRESHOLD)
+        hashes = self._get_hashes(ads, ['filetype'], view)
+        file_type = (hashes.get('filetype') if hashes else None) or '-'
+        if skip_types and (file_type in skip_types or category(file_type) in skip_types):
+            return []
+
+        view.load(self.YARA_WINDOW_THRESHOLD)
+        hashes = self._get_hashes(ads, set(digests) | {'md5'}, view)
+        externals = {
+            'filename': self.path.name,
+            'filepath': str(self.path),
+            'extension': self.path.suffix,
+            'filetype': file_type,
+            'md5': hashes['md5'].hexdigest() if hashes else None
+        }
+
+        matches = []
+        seen = set()
+        windowed = not view.mapped and size > window_size
+        windows = view.iter_windows(size, window_size, overlap) if size else [b'']
+        offset = 0
+        for window in windows:
+            for rule in rules:
+                try:
+                    for match in rule.match(data=window, fast=fast, externals=externals):
+                        key = (id(rule), match.namespace, match.rule)
+                        if key not in seen:
+                            seen.add(key)
+                            matches.append(WindowMatch(match, offset) if windowed else match)
+                except yara.Error:
+                    logging.exception("Yara error")
+            # The next window starts with the overlap kept from this one
+            offset += len(window) - min(overlap, len(window))
+        return matches
+
+
+class BlockCache(object):
+    """
+    LRU cache of aligned stream blocks, shared by the TSKData objects of a drive
+
+    Small reads are served from BLOCK_SIZE aligned blocks kept in memory, reads of at least bypass_size bytes
+    (sequential hashing / scanning) go straight to the disk.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, block_size=64 * 1024, bypass_size=256 * 1024):
+        self.block_size = block_size
+        self.bypass_size = bypass_size
+        self.max_blocks = max(1, max_size // block_size)
+        self.hits = 0
+        self.misses = 0
+        self.__blocks = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def read(self, key, offset, length, size, read_random):
+        """
+        Read some data of a stream through the cache
+
+        Args:
+            key: identifier of the stream on the drive
+            offset: offset of the data in the stream
+            length: number of bytes to read
+            size: size of the stream
+            read_random: function(offset, length) reading the stream from the disk
+
+        Returns:
+            bytes object
+        """
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        start = offset - first * self.block_size
+        if first == last:
+            return self.__get_block(key, first, size, read_random)[start:start + length]
+
+        chunks = []
+        for index in range(first, last + 1):
+            block = self.__get_block(key, index, size, read_random)
+            chunks.append(block)
+            if len(block) < self.block_size:
+                break
+        return b''.join(chunks)[start:start + length]
+
+    def __get_block(self, key, index, size, read_random):
+        with self.__lock:
+            block = self.__blocks.get((key, index))
+            if block is not None:
+                self.__blocks.move_to_end((key, index))
+                self.hits += 1
+                return block
+            self.misses += 1
+
+        offset = index * self.block_size
+        block = read_random(offset, min(self.block_size, size - offset))
+        with self.__lock:
+            self.__blocks[(key, index)] = block
+            while len(self.__blocks) > self.max_blocks:
+                self.__blocks.popitem(last=False)
+        return block
+
+    def clear(self):
+        """Empty the cache"""
+        with self.__lock:
+            self.__blocks.clear()
+
+    def stats(self):
+        """Get the cache statistics"""
+        return dict(
+            blocks=len(self.__blocks),
+            max_blocks=self.max_blocks,
+            hits=self.hits,
+            misses=self.misses,
+        )
 
 
 class TSKData(io.BufferedIOBase):
     BUF_SIZE = 1024 * 1024
 
-    def __init__(self, directory_entry, stream):
+    def __init__(self, directory_entry, stream, block_cache=None):
         super(TSKData, self).__init__()
         self.__offset = 0
         self.__directory_entry = directory_entry
         self.__stream = stream
+        self.__block_cache = block_cache
 
     def readable(self):
         return True
@@ -191,16 +1059,13 @@ class TSKData(io.BufferedIOBase):
         Read and return up to n bytes.
         If the argument is omitted, None, or negative, data is read and returned until EOF is reached..
         """
+        if n is None or n < 0:
+            n = self.__stream['size']
         available_to_read = min(n, self.__stream['size'] - self.__offset)
         if available_to_read <= 0:
             return b''
 
-        data = self.__directory_entry.read_random(
-            offset=self.__offset,
-            len=available_to_read,
-            type=self.__stream['type'],
-            id=self.__stream['id']
-        )
+        data = self.__read(available_to_read)
         self.__offset += len(data)
         return data
 
@@ -211,14 +1076,38 @@ class TSKData(io.BufferedIOBase):
         if available_to_read <= 0:
             return b''
 
-        data = self.__directory_entry.read_random(
-            offset=self.__offset,
-            len=available_to_read,
+        data = self.__read(available_to_read)
+        self.__offset += len(data)
+        return data
+
+    def readinto(self, b):
+        """Read bytes into a pre-allocated, writable bytes-like object b, returns the number of bytes read"""
+        view = memoryview(b).cast('B')
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def readinto1(self, b):
+        """Read bytes into b with at most one read() system call, returns the number of bytes read"""
+        view = memoryview(b).cast('B')
+        data = self.read1(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def __read_random(self, offset, length):
+        return self.__directory_entry.read_random(
+            offset=offset,
+            len=length,
             type=self.__stream['type'],
             id=self.__stream['id']
         )
-        self.__offset += len(data)
-        return data
+
+    def __read(self, length):
+        """Read length bytes at the current offset, using the block cache for small reads"""
+        if self.__block_cache is None or length >= self.__block_cache.bypass_size:
+            return self.__read_random(self.__offset, length)
+        return self.__block_cache.read(
+            self.__stream['inode'], self.__offset, length, self.__stream['size'], self.__read_random)
 
     def seekable(self):
         return True
@@ -246,7 +1135,12 @@ class TSKData(io.BufferedIOBase):
 class TSKFile(_File):
     """
     Concrete implementation of file for TSK volumes
+
+    The file only keeps references to its libtsk objects, the path and the streams metadata are built on first
+    access so enumerating a volume stays cheap.
     """
+    __slots__ = ('__drive', '__directory_entry', '__parent_path', '__meta', '__name', '__path', '__streams',
+                 'pe_data')
 
     def __init__(self, drive, directory_entry, parent_path):
         if not TSK_SUPPORT:
@@ -257,15 +1151,15 @@ class TSKFile(_File):
         self.__parent_path = parent_path
         self.__meta = self.__directory_entry.info.meta
         self.__name = self.__directory_entry.info.name
-        self.__attrs = dict(
-            filename=self.__name.name,
-            streams={},
-            path=self.__parent_path / self.__name.name.decode('utf-8', errors='replace'),
-        )
-        self.__parse()
+        self.__path = None
+        self.__streams = None
         self.pe_data = None
+        self.read_mode = 'auto'
+        self.hash_cache = drive.hash_cache
+        self.pe_cache = drive.pe_cache
 
     def __parse(self):
+        streams = dict()
         for attribute in self.__directory_entry:
             inode_type = int(attribute.info.type)
             if inode_type in [
@@ -285,13 +1179,31 @@ class TSKFile(_File):
                     ctime=self.__meta.ctime,
                     mtime=self.__meta.mtime,
                     atime=self.__meta.atime,
+                    ctime_nano=self.__meta.ctime_nano,
+                    mtime_nano=self.__meta.mtime_nano,
                 )
 
-                self.__attrs['streams'][
-                    attribute_name.decode('utf-8', errors='replace') if attribute_name else '$Data'] = attrs
+                streams[attribute_name.decode('utf-8', errors='replace') if attribute_name else '$Data'] = attrs
+        return streams
 
-    def __getattr__(self, item):
-        return self.__attrs.get(item)
+    @property
+    def filename(self):
+        """Raw name of the file"""
+        return self.__name.name
+
+    @property
+    def path(self):
+        """Path of the file on the drive"""
+        if self.__path is None:
+            self.__path = self.__parent_path / self.__name.name.decode('utf-8', errors='replace')
+        return self.__path
+
+    @property
+    def streams(self):
+        """Data streams of the file, parsed on first access"""
+        if self.__streams is None:
+            self.__streams = self.__parse()
+        return self.__streams
 
     def is_directory(self):
         """Returns if a file is a directory"""
@@ -305,15 +1217,57 @@ class TSKFile(_File):
         if self.__name:
             return int(self.__name.flags) & pytsk3.TSK_FS_NAME_FLAG_UNALLOC != 0
 
-    def get_data(self, name=None, mode='raw'):
+    def _cache_key(self, name):
+        """Cache key of a stream: volume, stream inode, size, mtime and ctime (with their nanoseconds)"""
+        stream = self.streams.get(name or '$Data')
+        if not stream:
+            return None
+        return '{}|{}|{}|{}.{:09d}|{}.{:09d}'.format(
+            self.__drive.drive_name, stream['inode'], stream['size'], stream['mtime'], stream['mtime_nano'],
+            stream['ctime'], stream['ctime_nano'])
+
+    def data_streams(self):
+        """Names of the data streams of the file, '$Data' being the default stream"""
+        return [name for name, stream in self.streams.items()
+                if stream['type'] != pytsk3.TSK_FS_ATTR_TYPE_NTFS_IDXROOT]
+
+    def get_first_block(self, name=None):
+        """
+        Get the address of the first allocated block of a data stream, used to read the files in physical order
+
+        Returns:
+            int, the block number on the file system
+            None for resident, empty or sparse streams
+        """
+        stream = self.streams.get(name or '$Data')
+        if not stream:
+            return None
+        for attribute in self.__directory_entry:
+            if int(attribute.info.type) != stream['type'] or attribute.info.id != stream['id']:
+                continue
+            if int(attribute.info.flags) & pytsk3.TSK_FS_ATTR_NONRES:
+                for run in attribute:
+                    if not int(run.flags) & (pytsk3.TSK_FS_ATTR_RUN_FLAG_SPARSE | pytsk3.TSK_FS_ATTR_RUN_FLAG_FILLER):
+                        return run.addr
+            break
+        return None
+
+    @property
+    def os_path(self):
+        """Path of the file for the operating system, below the mount point of the drive"""
+        return Path(self.__drive.basepath) / self.path.relative_to('/')
+
+    def get_data(self, name=None, mode='auto'):
         """
         Return some data from the file
 
         Args:
-            name: None or the name of the data stream3
+            name: None or the name of the data stream
             mode: The way to read files:
               - 'raw' reads the data from the disk (slow, but bypass security and locks)
               - 'standard' uses the standard API to read files (fast, can fail because of security descriptors or locks)
+              - 'auto' tries the standard API first and falls back to raw reads if the file cannot be opened,
+                reads raw directly if the drive is not mounted at its basepath (disk images, unmounted volumes)
 
         Returns:
             File-like object
@@ -321,45 +1275,53 @@ class TSKFile(_File):
         """
         if not name:
             name = '$Data'
-        stream = self.__attrs['streams'].get(name)
+        stream = self.streams.get(name)
         if not stream:
             return None
 
-        if mode == 'standard':
-            if name == '$Data':
-                path = self.__attrs['path']
-            else:
-                path = self.__parent_path / '{}:{}'.format(self.__name.name.decode('utf-8', errors='replace'), name)
-            return path.open('rb')
+        if mode == 'auto':
+            # Deleted files, unmounted drives and alternate data streams outside of Windows are only reachable with
+            # raw reads, links, directories and special files are read raw so that the OS does not follow or block
+            if (not self.is_deleted() and (name == '$Data' or os.name == 'nt') and self.__drive.is_mounted and
+                    self.__meta is not None and self.__meta.type == pytsk3.TSK_FS_META_TYPE_REG):
+                try:
+                    data_file = self.__open_standard(name)
+                    self.__drive.read_stats['standard'] += 1
+                    return data_file
+                except OSError:
+                    # Permission denied, sharing violation, locked or vanished file
+                    self.__drive.read_stats['fallback'] += 1
+            self.__drive.read_stats['raw'] += 1
+            return TSKData(self.__directory_entry, stream, self.__drive.block_cache)
+        elif mode == 'standard':
+            self.__drive.read_stats['standard'] += 1
+            return self.__open_standard(name)
         elif mode == 'raw':
-            return TSKData(self.__directory_entry, stream)
+            self.__drive.read_stats['raw'] += 1
+            return TSKData(self.__directory_entry, stream, self.__drive.block_cache)
         return None
 
-    def scan_yara(self, rules, ads=None, fast=False):
-        """Scan the file using yara rules"""
-        matches = []
-        for rule in rules:
-            try:
-                matches += rule.match(
-                    data=self.get_data(ads).read(),
-                    fast=fast,
-                    externals={
-                        'filename': self.path.name,
-                        'filepath': str(self.path),
-                        'extension': self.path.suffix,
-                        'filetype': '-',
-                        'md5': self.get_hash_md5(ads)
-                    })
-            except yara.Error:
-                logging.exception("Yara error")
-        return matches
+    def __open_standard(self, name):
+        """Open a regular file with the standard API, without following links or blocking on special files"""
+        path = self.os_path
+        if name != '$Data':
+            path = path.with_name('{}:{}'.format(path.name, name))
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_NONBLOCK', 0)
+        fd = os.open(str(path), flags)
+        try:
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                raise OSError(errno.EINVAL, "Not a regular file", str(path))
+        except OSError:
+            os.close(fd)
+            raise
+        return os.fdopen(fd, 'rb')
 
     def get_pe(self, force=False):
         """
         Returns the pefile.PE object if the file is actually a PE
 
         Args:
-            force: Disable extension detection for PE files (default False)
+            force: Disable the extension and file type detection of PE files (default False)
 
         Returns:
             pefile.PE
@@ -367,10 +1329,10 @@ class TSKFile(_File):
         """
         if not PEFILE_SUPPORT:
             return None
-        if force or self.__attrs['path'].suffix in ['.dll', '.exe', '.sys']:
+        if force or self.path.suffix.lower() in self.PE_EXTENSIONS or self.get_filetype() == 'pe':
             try:
                 data = self.get_data()
-                self.pe_data = PE(name=str(self.__attrs['path']), data=data, fast_load=True)
+                self.pe_data = PE(name=str(self.path), data=data, fast_load=True)
                 return self.pe_data
             except PEFormatError:
                 return None
@@ -379,13 +1341,15 @@ class TSKFile(_File):
         return None
 
     def __repr__(self):
-        return "{} {}".format(self.__attrs['path'], self.__attrs['path'].suffixes)
+        return "{} {}".format(self.path, self.path.suffixes)
 
 
 class AndroidFile(_File):
-    def __init__(self, entry):
+    def __init__(self, entry, hash_cache=None, pe_cache=None):
         super(AndroidFile, self).__init__()
         self.read_mode = 'standard'
+        self.hash_cache = hash_cache
+        self.pe_cache = pe_cache
         self.__entry = entry
         self._follow_symlinks = False
         stat = entry.stat(follow_symlinks=self._follow_symlinks)  # type: os.stat_result
@@ -393,6 +1357,7 @@ class AndroidFile(_File):
             None: dict(
                 size=stat.st_size,
                 mode=stat.st_mode,
+                dev=stat.st_dev,
                 inode=stat.st_ino,
                 uid=stat.st_uid,
                 gid=stat.st_gid,
@@ -410,12 +1375,30 @@ class AndroidFile(_File):
             raise NotImplementedError()
         return self.path.open('rb')
 
+    def _cache_key(self, name):
+        """Cache key of the file: device, inode, size, mtime and ctime"""
+        if name:
+            return None
+        stream = self.streams[None]
+        return '{}|{}|{}|{}|{}'.format(
+            stream['dev'], stream['inode'], stream['size'], stream['mtime'], stream['ctime'])
+
     @property
     def path(self):
         return Path(self.__entry.path)
 
-    def scan_yara(self, rules, _=None, fast=False):
-        """Scan the file using yara rules"""
+    def scan_yara(self, rules, _=None, fast=False, max_bytes=None, skip_types=None):
+        """
+        Scan the file using yara rules (compiled rules or YaraRuleset, or a list of them)
+
+        The whole file is scanned by yara, max_bytes is ignored. The file types or categories of skip_types
+        (see epclib.filesystem.filetype) are not scanned.
+        """
+        if not isinstance(rules, (list, tuple)):
+            rules = [rules]
+        file_type = self.get_filetype() or '-'
+        if skip_types and (file_type in skip_types or category(file_type) in skip_types):
+            return []
         matches = []
         for rule in rules:
             try:
@@ -426,9 +1409,124 @@ class AndroidFile(_File):
                         'filename': self.path.name,
                         'filepath': str(self.path),
                         'extension': self.path.suffix,
-                        'filetype': '-',
+                        'filetype': file_type,
                         'md5': self.get_hash_md5()
                     })
             except yara.Error:
                 logging.exception("Yara error")
         return matches
+
+    def _scan_view(self, rules, ads, view, fast=False, max_bytes=None, skip_types=None, digests=('md5',)):
+        # yara reads the file by itself
+        return self.scan_yara(rules, ads, fast, max_bytes, skip_types)
+
+
+class NativeFile(_File):
+    """
+    Concrete implementation of file for mounted file systems, listed with os.scandir
+
+    The stat data of the directory entry is reused (it is fetched once and cached by os.DirEntry) and only
+    requested when the streams are accessed.
+    """
+    __slots__ = ('__drive', '__entry', '__parent_path', '__path', '__streams')
+
+    def __init__(self, drive, entry, parent_path):
+        super(NativeFile, self).__init__()
+        self.__drive = drive
+        self.__entry = entry  # type: os.DirEntry
+        self.__parent_path = parent_path
+        self.__path = None
+        self.__streams = None
+        self.read_mode = 'standard'
+        self.hash_cache = drive.hash_cache
+        self.pe_cache = drive.pe_cache
+
+    @property
+    def filename(self):
+        """Raw name of the file"""
+        return os.fsencode(self.__entry.name)
+
+    @property
+    def path(self):
+        """Path of the file from the root of the drive"""
+        if self.__path is None:
+            self.__path = self.__parent_path / self.__entry.name
+        return self.__path
+
+    @property
+    def os_path(self):
+        """Path of the file for the operating system"""
+        return Path(self.__entry.path)
+
+    @property
+    def streams(self):
+        """Metadata of the data stream, '$Data' like the default stream of TSKFile"""
+        if self.__streams is None:
+            try:
+                st = self.__entry.stat(follow_symlinks=False)
+            except OSError:
+                self.__streams = dict()
+                return self.__streams
+            self.__streams = {
+                '$Data': dict(
+                    inode=st.st_ino,
+                    dev=st.st_dev,
+                    size=st.st_size,
+                    mode=st.st_mode,
+                    uid=st.st_uid,
+                    gid=st.st_gid,
+                    ctime=st.st_ctime,
+                    mtime=st.st_mtime,
+                    atime=st.st_atime,
+                )
+            }
+        return self.__streams
+
+    def is_directory(self):
+        """Check if the file is a directory"""
+        try:
+            return self.__entry.is_dir(follow_symlinks=False)
+        except OSError:
+            return False
+
+    def is_deleted(self):
+        """Files listed from the operating system are never deleted"""
+        return False
+
+    def is_regular(self):
+        """Check if the file is a regular file (not a directory, link, device, pipe or socket)"""
+        stream = self.streams.get('$Data')
+        return stream is not None and stat.S_ISREG(stream['mode'])
+
+    def _cache_key(self, name):
+        """Cache key of the file: device, inode, size, mtime and ctime"""
+        stream = self.streams.get(name or '$Data')
+        if not stream:
+            return None
+        return '{}|{}|{}|{}|{}'.format(
+            stream['dev'], stream['inode'], stream['size'], stream['mtime'], stream['ctime'])
+
+    def data_streams(self):
+        """Names of the data streams of the file, only regular files have data"""
+        return ['$Data'] if self.is_regular() else []
+
+    def get_data(self, name=None, mode='standard'):
+        """
+        Return the data of the file
+
+        Only regular files are opened, so that pipes and devices cannot block the scan.
+
+        Args:
+            name: None or '$Data'
+            mode: only 'standard' and 'auto' are supported
+
+        Returns:
+            File-like object
+            None
+        """
+        if name not in (None, '$Data') or mode not in ('standard', 'auto') or not self.is_regular():
+            return None
+        return self.os_path.open('rb')
+
+    def __repr__(self):
+        return "{} {}".format(self.path, self.path.suffixes)
@@ -0,0 +1,136 @@
+"""
+filetype.py : File type detection from the first bytes of a file
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import struct
+
+SNIFF_SIZE = 4096
+
+# (offset, magic, file type), checked in order
+MAGICS = [
+    (0, b'\x7fELF', 'elf'),
+    (0, b'\xfe\xed\xfa\xce', 'macho'),
+    (0, b'\xfe\xed\xfa\xcf', 'macho'),
+    (0, b'\xce\xfa\xed\xfe', 'macho'),
+    (0, b'\xcf\xfa\xed\xfe', 'macho'),
+    (0, b'dex\n', 'dex'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'ole'),
+    (0, b'{\\rtf', 'rtf'),
+    (0, b'\x1f\x8b', 'gzip'),
+    (0, b'BZh', 'bzip2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'7z\xbc\xaf\x27\x1c', '7z'),
+    (0, b'Rar!\x1a\x07', 'rar'),
+    (0, b'MSCF', 'cab'),
+    (0, b'\x28\xb5\x2f\xfd', 'zstd'),
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (0, b'ID3', 'mp3'),
+    (0, b'OggS', 'ogg'),
+    (0, b'fLaC', 'flac'),
+    (0, b'\x1a\x45\xdf\xa3', 'mkv'),
+    (4, b'ftyp', 'mp4'),
+    (8, b'WAVE', 'wav'),
+    (8, b'AVI ', 'avi'),
+    (8, b'WEBP', 'webp'),
+]
+
+CATEGORIES = dict(
+    executable=('pe', 'dos', 'elf', 'macho', 'dex', 'java'),
+    archive=('zip', 'jar', 'apk', 'gzip', 'bzip2', 'xz', '7z', 'rar', 'cab', 'zstd'),
+    document=('ooxml', 'pdf', 'ole', 'rtf', 'html', 'xml'),
+    media=('jpeg', 'png', 'gif', 'mp3', 'mp4', 'wav', 'avi', 'webp', 'ogg', 'flac', 'mkv'),
+    script=('script',),
+    text=('text',),
+)
+
+SCRIPT_MARKERS = (b'<?php', b'<script', b'@echo off', b'powershell', b'wscript.', b'createobject(', b'eval(')
+
+# Bytes found in text files (see the file(1) heuristics)
+_TEXT_CHARS = bytes(bytearray({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f}))
+
+
+def _sniff_mz(data):
+    pe_offset = struct.unpack_from('<I', data, 0x3c)[0] if len(data) >= 0x40 else None
+    if pe_offset is None or pe_offset + 4 > len(data):
+        # The PE header is out of the sniffed data, assume a PE
+        return 'pe'
+    return 'pe' if data[pe_offset:pe_offset + 4] == b'PE\0\0' else 'dos'
+
+
+def _sniff_zip(data):
+    if b'[Content_Types].xml' in data:
+        return 'ooxml'
+    if b'AndroidManifest.xml' in data or b'classes.dex' in data:
+        return 'apk'
+    if b'META-INF/' in data:
+        return 'jar'
+    return 'zip'
+
+
+def _sniff_text(data):
+    if data.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'text'
+    if b'\0' in data or len(data.translate(None, _TEXT_CHARS)) * 20 > len(data):
+        return None
+    if data.startswith(b'#!'):
+        return 'script'
+    lowered = data.lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if lowered.startswith((b'<!doctype html', b'<html')):
+        return 'html'
+    if lowered.startswith(b'<?xml'):
+        return 'xml'
+    if any(marker in lowered for marker in SCRIPT_MARKERS):
+        return 'script'
+    return 'text'
+
+
+def sniff(data):
+    """
+    Get the type of a file from its first bytes (SNIFF_SIZE is enough)
+
+    Returns:
+        str, see CATEGORIES, 'empty' or 'data' for unknown binary data
+    """
+    data = bytes(data[:SNIFF_SIZE])
+    if not data:
+        return 'empty'
+    if data.startswith(b'MZ'):
+        return _sniff_mz(data)
+    if data.startswith(b'PK\x03\x04'):
+        return _sniff_zip(data)
+    if data.startswith(b'\xca\xfe\xba\xbe') and len(data) >= 8:
+        # Mach-O universal binaries and java classes share their magic, fat binaries have few architectures
+        return 'macho' if struct.unpack_from('>I', data, 4)[0] < 32 else 'java'
+    for offset, magic, file_type in MAGICS:
+        if data[offset:offset + len(magic)] == magic:
+            return file_type
+    if b'%PDF-' in data[:1024]:
+        return 'pdf'
+    return _sniff_text(data) or 'data'
+
+
+def category(file_type):
+    """Get the category of a file type, None for unknown types"""
+    for name, file_types in CATEGORIES.items():
+        if file_type in file_types:
+            return name
+    return None
@@ -0,0 +1,154 @@
+"""
+filters.py : Declarative file filters evaluated while enumerating the drives
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import fnmatch
+import re
+
+
+class FileFilter(object):
+    """
+    Filter of the enumerated files, compiled once and checked on the raw directory entries
+
+    The name, extension, size and mtime conditions apply to the files, the directories are listed unless
+    directories is False. The include / exclude prefixes (paths from the root of the drive) apply to both and
+    the excluded sub-trees are not walked at all.
+    """
+
+    def __init__(self, names=None, extensions=None, min_size=None, max_size=None, min_mtime=None, max_mtime=None,
+                 include=None, exclude=None, directories=True, case_sensitive=False):
+        """
+        Args:
+            names: glob patterns of the file names (ex: '*.exe', 'ntuser.dat')
+            extensions: file extensions, with or without the leading dot
+            min_size, max_size: size range in bytes (inclusive)
+            min_mtime, max_mtime: modification time range as a timestamp (inclusive)
+            include: only list the files below these paths
+            exclude: do not list the files below these paths
+            directories: list the directories
+            case_sensitive: compare the names and paths case sensitively
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_mtime = min_mtime
+        self.max_mtime = max_mtime
+        self.directories = directories
+        self.case_sensitive = case_sensitive
+
+        flags = 0 if case_sensitive else re.IGNORECASE
+        if names:
+            pattern = '|'.join('(?:{})'.format(fnmatch.translate(name)) for name in names)
+            self.__names = re.compile(pattern, flags)
+            self.__raw_names = re.compile(pattern.encode('utf-8'), flags)
+        else:
+            self.__names = self.__raw_names = None
+        self.__extensions = None
+        if extensions:
+            self.__extensions = {self.__fold('.' + extension.lstrip('.')) for extension in extensions}
+        self.__include = tuple(self.__prefix(path) for path in include or [])
+        self.__exclude = tuple(self.__prefix(path) for path in exclude or [])
+        # The walkers only compute the paths and read the metadata of the entries when needed
+        self.needs_path = bool(self.__include or self.__exclude)
+        self.needs_meta = any(value is not None for value in (min_size, max_size, min_mtime, max_mtime))
+
+    @classmethod
+    def from_dict(cls, spec):
+        """Build a filter from a dict of the __init__ arguments (ex: loaded from a JSON task)"""
+        return cls(**spec) if spec else None
+
+    def __fold(self, value):
+        return value if self.case_sensitive else value.lower()
+
+    def __prefix(self, path):
+        return self.__fold(str(path).replace('\\', '/').rstrip('/') + '/')
+
+    def match_path(self, path):
+        """Check that a path (from the root of the drive) is included and not excluded"""
+        path = self.__fold(path) + '/'
+        if self.__exclude and path.startswith(self.__exclude):
+            return False
+        return not self.__include or path.startswith(self.__include)
+
+    def match_directory(self, path):
+        """Check if the files below a directory can match, so that it must be walked"""
+        path = self.__fold(path) + '/'
+        if self.__exclude and path.startswith(self.__exclude):
+            return False
+        if not self.__include:
+            return True
+        # Walk the included trees and their parents
+        return any(path.startswith(prefix) or prefix.startswith(path) for prefix in self.__include)
+
+    def match_name(self, name):
+        """Check the name and extension of a file, name is a str or the raw bytes of the directory entry"""
+        raw = isinstance(name, bytes)
+        if self.__names is not None and not (self.__raw_names if raw else self.__names).match(name):
+            return False
+        if self.__extensions is not None:
+            if raw:
+                name = name.decode('utf-8', errors='replace')
+            dot = name.rfind('.')
+            if dot <= 0 or self.__fold(name[dot:]) not in self.__extensions:
+                return False
+        return True
+
+    def match_meta(self, size, mtime):
+        """Check the size and mtime of a file"""
+        if self.min_size is not None and (size is None or size < self.min_size):
+            return False
+        if self.max_size is not None and (size is None or size > self.max_size):
+            return False
+        if self.min_mtime is not None and (mtime is None or mtime < self.min_mtime):
+            return False
+        if self.max_mtime is not None and (mtime is None or mtime > self.max_mtime):
+            return False
+        return True
+
+    def match_entry(self, name, is_directory, path=None, meta=None):
+        """
+        Check a raw directory entry before building its file object
+
+        Args:
+            name: name of the entry (str or bytes)
+            is_directory: the entry is a directory
+            path: path of the entry from the root of the drive, only required if needs_path
+            meta: callable returning (size, mtime), only called if needs_meta
+
+        Returns:
+            bool
+        """
+        if is_directory:
+            return self.directories and (path is None or self.match_path(path))
+        if path is not None and not self.match_path(path):
+            return False
+        if not self.match_name(name):
+            return False
+        return not self.needs_meta or self.match_meta(*meta())
+
+    def match(self, myfile):
+        """Check an already built file object"""
+        path = str(myfile.path)
+        if myfile.is_directory():
+            return self.directories and self.match_path(path)
+        if not self.match_path(path) or not self.match_name(myfile.path.name):
+            return False
+        if self.needs_meta:
+            stream = myfile.streams.get('$Data') or myfile.streams.get(None) or dict()
+            return self.match_meta(stream.get('size'), stream.get('mtime'))
+        return True
@@ -0,0 +1,230 @@
+"""
+index.py : Persistent file index used to list the changes between two sweeps of a volume
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from epc.common.settings import Config
+
+# status is 'added', 'modified' or 'deleted', file is None for deleted entries and previous is None for added ones
+Change = collections.namedtuple('Change', ('status', 'path', 'file', 'previous'))
+
+
+def _signature(streams):
+    """Fields of the streams which change when a file is modified (the access time is left out)"""
+    return json.dumps(
+        {str(name): [stream.get('inode'), stream.get('size'), stream.get('mtime'), stream.get('ctime'),
+                     stream.get('mtime_nano'), stream.get('ctime_nano')]
+         for name, stream in streams.items()},
+        sort_keys=True)
+
+
+class FileIndex(object):
+    """
+    SQLite index of the files of a volume: path, inode, size, times, streams and digests
+
+    diff() compares an enumeration with the previous sweep and only yields the added, modified and deleted
+    entries. The index is updated in a single transaction committed at the end of the sweep, so an interrupted
+    sweep leaves the previous index untouched.
+    """
+
+    def __init__(self, volume, path=None):
+        """
+        Args:
+            volume: name of the volume (ex: drive.drive_name)
+            path: path of the index (default BINCACHE_DIR/index-<volume hash>.sqlite)
+        """
+        if not path:
+            os.makedirs(Config().BINCACHE_DIR, exist_ok=True)
+            name = hashlib.sha1(str(volume).encode('utf-8')).hexdigest()[:16]
+            path = os.path.join(Config().BINCACHE_DIR, 'index-{}.sqlite'.format(name))
+        self.volume = volume
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute(
+            'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, inode TEXT, size INTEGER, mtime REAL, '
+            'ctime REAL, signature TEXT, streams TEXT, digests TEXT, sweep INTEGER)')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS sweeps (id INTEGER PRIMARY KEY, volume TEXT)')
+        row = self.__db.execute('SELECT MAX(id) FROM sweeps').fetchone()
+        self.sweep = row[0] or 0
+        self.__db.commit()
+
+    @classmethod
+    def for_drive(cls, drive, path=None):
+        """Get the index of a drive"""
+        return cls(drive.drive_name, path)
+
+    def __len__(self):
+        with self.__lock:
+            return self.__db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def get(self, path):
+        """
+        Get the indexed entry of a path
+
+        Returns:
+            dict(path, inode, size, mtime, ctime, streams, digests)
+            None if the path is not indexed
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT path, inode, size, mtime, ctime, streams, digests FROM files WHERE path = ?',
+                (str(path),)).fetchone()
+        return self.__entry(row) if row else None
+
+    @staticmethod
+    def __entry(row):
+        return dict(
+            path=row[0],
+            inode=row[1],
+            size=row[2],
+            mtime=row[3],
+            ctime=row[4],
+            streams=json.loads(row[5]) if row[5] else dict(),
+            digests=json.loads(row[6]) if row[6] else dict(),
+        )
+
+    def diff(self, files, scope=None):
+        """
+        Compare an enumeration with the index and update it
+
+        The changed entries are yielded while files is consumed, the deleted ones once it is exhausted, the index
+        is then committed. Unchanged files keep their digests, the digests of modified files are cleared.
+
+        Args:
+            files: iterable of _File, usually from Drive.enumerate_files
+            scope: paths of the enumerated directories, entries outside of them are not reported as deleted
+                   (default: the whole volume), (path, recursive) tuples limit a directory to its direct content
+
+        Returns:
+            Yields Change
+        """
+        with self.__lock:
+            self.sweep += 1
+            sweep = self.sweep
+            self.__db.execute('INSERT INTO sweeps (id, volume) VALUES (?, ?)', (sweep, str(self.volume)))
+        try:
+            for myfile in files:
+                path = str(myfile.path)
+                try:
+                    streams = myfile.streams
+                except OSError:
+                    continue
+                signature = _signature(streams)
+                with self.__lock:
+                    row = self.__db.execute(
+                        'SELECT path, inode, size, mtime, ctime, streams, digests, signature FROM files '
+                        'WHERE path = ?', (path,)).fetchone()
+                    if row is not None and row[7] == signature:
+                        self.__db.execute('UPDATE files SET sweep = ? WHERE path = ?', (sweep, path))
+                        continue
+                    self.__write(path, streams, signature, sweep)
+                yield Change('modified' if row else 'added', path, myfile, self.__entry(row) if row else None)
+
+            for row in self.__deleted(sweep, scope):
+                yield Change('deleted', row[0], None, self.__entry(row))
+            with self.__lock:
+                self.__db.execute('DELETE FROM files WHERE sweep < ? AND path IN (SELECT path FROM deleted)',
+                                  (sweep,))
+                self.__db.execute('DROP TABLE deleted')
+                self.__db.commit()
+        except BaseException:
+            with self.__lock:
+                self.__db.rollback()
+                self.sweep -= 1
+            raise
+
+    def __deleted(self, sweep, scope):
+        """Select the entries which were not seen in the sweep, in a temporary table to remove them afterwards"""
+        with self.__lock:
+            self.__db.execute('CREATE TEMP TABLE deleted (path TEXT PRIMARY KEY)')
+            if not scope:
+                self.__db.execute('INSERT INTO deleted SELECT path FROM files WHERE sweep < ?', (sweep,))
+            for prefix in scope or []:
+                prefix, recursive = prefix if isinstance(prefix, tuple) else (prefix, True)
+                prefix = str(prefix).rstrip('/')
+                # The scope directory itself is listed by the enumeration of its parent, not by its own
+                if recursive:
+                    self.__db.execute(
+                        'INSERT OR IGNORE INTO deleted SELECT path FROM files WHERE sweep < ? AND '
+                        'substr(path, 1, ?) = ?',
+                        (sweep, len(prefix) + 1, prefix + '/'))
+                else:
+                    self.__db.execute(
+                        'INSERT OR IGNORE INTO deleted SELECT path FROM files WHERE sweep < ? AND '
+                        'substr(path, 1, ?) = ? AND instr(substr(path, ?), \'/\') = 0',
+                        (sweep, len(prefix) + 1, prefix + '/', len(prefix) + 2))
+            if scope:
+                # The content of the deleted directories is gone too, unless it was seen (filtered out parent...)
+                self.__db.execute(
+                    'INSERT OR IGNORE INTO deleted SELECT files.path FROM files, deleted WHERE files.sweep < ? AND '
+                    'substr(files.path, 1, length(deleted.path) + 1) = deleted.path || \'/\'', (sweep,))
+            rows = self.__db.execute(
+                'SELECT path, inode, size, mtime, ctime, streams, digests FROM files '
+                'WHERE path IN (SELECT path FROM deleted)').fetchall()
+        return rows
+
+    def __write(self, path, streams, signature, sweep):
+        stream = streams.get('$Data') or streams.get(None) or dict()
+        self.__db.execute(
+            'INSERT OR REPLACE INTO files (path, inode, size, mtime, ctime, signature, streams, digests, sweep) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?)',
+            (path, str(stream.get('inode')), stream.get('size'), stream.get('mtime'), stream.get('ctime'),
+             signature, json.dumps({str(name): value for name, value in streams.items()}), sweep))
+
+    def set_digests(self, myfile, hashes, name=None):
+        """
+        Store the digests of a file stream, see _File.get_hashes
+
+        Args:
+            myfile: indexed _File
+            hashes: dict returned by get_hashes
+            name: None or the name of the data stream
+        """
+        path = str(myfile.path)
+        with self.__lock:
+            row = self.__db.execute('SELECT digests FROM files WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return
+            digests = json.loads(row[0]) if row[0] else dict()
+            digests[name or '$Data'] = myfile.export_hashes(hashes)
+            self.__db.execute('UPDATE files SET digests = ? WHERE path = ?', (json.dumps(digests), path))
+
+    def get_digests(self, path, name=None):
+        """Get the stored digests of a file stream, see _File.import_hashes to restore them"""
+        entry = self.get(path)
+        if entry is None:
+            return None
+        return entry['digests'].get(name or '$Data')
+
+    def commit(self):
+        """Commit the digests stored after the end of a sweep"""
+        with self.__lock:
+            self.__db.commit()
+
+    def close(self):
+        """Commit and close the index"""
+        self.commit()
+        self.__db.close()
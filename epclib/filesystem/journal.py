@@ -0,0 +1,385 @@
+"""
+journal.py : Change journal of the mounted file systems (Linux fanotify / inotify)
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                 IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+FAN_CLOEXEC = 0x1
+FAN_NONBLOCK = 0x2
+FAN_REPORT_DFID_NAME = 0xc00
+FAN_MARK_ADD = 0x1
+FAN_MARK_FILESYSTEM = 0x100
+FAN_MODIFY = 0x2
+FAN_ATTRIB = 0x4
+FAN_CLOSE_WRITE = 0x8
+FAN_MOVED_FROM = 0x40
+FAN_MOVED_TO = 0x80
+FAN_CREATE = 0x100
+FAN_DELETE = 0x200
+FAN_Q_OVERFLOW = 0x4000
+FAN_ONDIR = 0x40000000
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+FAN_WATCH_MASK = (FAN_MODIFY | FAN_ATTRIB | FAN_CLOSE_WRITE | FAN_MOVED_FROM | FAN_MOVED_TO | FAN_CREATE |
+                  FAN_DELETE | FAN_ONDIR)
+AT_FDCWD = -100
+O_PATH = 0o10000000
+
+_INOTIFY_EVENT = struct.Struct('iIII')
+_FANOTIFY_EVENT = struct.Struct('IBBHQii')
+_FANOTIFY_INFO = struct.Struct('BBH8sIi')
+
+
+class _StatFS(ctypes.Structure):
+    """struct statfs64, the fsid of the file system is the one reported in the fanotify events"""
+    _fields_ = [
+        ('f_type', ctypes.c_long),
+        ('f_bsize', ctypes.c_long),
+        ('f_blocks', ctypes.c_uint64),
+        ('f_bfree', ctypes.c_uint64),
+        ('f_bavail', ctypes.c_uint64),
+        ('f_files', ctypes.c_uint64),
+        ('f_ffree', ctypes.c_uint64),
+        ('f_fsid', ctypes.c_char * 8),
+        ('f_namelen', ctypes.c_long),
+        ('f_frsize', ctypes.c_long),
+        ('f_flags', ctypes.c_long),
+        ('f_spare', ctypes.c_long * 4),
+    ]
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    _libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    _libc.open_by_handle_at.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    _libc.fstatfs64.argtypes = [ctypes.c_int, ctypes.POINTER(_StatFS)]
+    JOURNAL_SUPPORT = True
+except (OSError, AttributeError):
+    JOURNAL_SUPPORT = False
+    pass
+
+
+def _errno_error():
+    code = ctypes.get_errno()
+    return OSError(code, os.strerror(code))
+
+
+def _fsid(fd):
+    """Get the fsid of the file system of a descriptor, as the raw bytes of the fanotify events"""
+    statfs = _StatFS()
+    if _libc.fstatfs64(fd, ctypes.byref(statfs)) < 0:
+        raise _errno_error()
+    return statfs.f_fsid
+
+
+def _is_below(path, parent):
+    return path == parent or path.startswith(parent.rstrip('/') + '/')
+
+
+class ChangeJournal(object):
+    """
+    Deduplicated set of the directories changed since the last scan
+
+    The mount points are watched with fanotify (whole file systems, needs CAP_SYS_ADMIN and Linux 5.9) or with
+    one inotify watch per directory. A change marks its parent directory dirty, new or moved directories and the
+    directories which could not be watched are dirty with their sub-directories. When the kernel queue
+    overflows, every watched mount point is marked dirty with its sub-directories.
+    """
+    READ_SIZE = 64 * 1024
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, paths, backend='auto'):
+        """
+        Args:
+            paths: mount points (or directories for inotify) to watch
+            backend: 'fanotify', 'inotify' or 'auto' (fanotify if available, inotify otherwise)
+        """
+        if not JOURNAL_SUPPORT:
+            raise NotImplementedError()
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.backend = backend
+        self.overflows = 0
+        self.__lock = threading.Lock()
+        # Directory -> True if its sub-directories are dirty too
+        self.__dirty = dict()
+        # Directories which could not be watched (inotify watch limit...), always dirty
+        self.__unwatched = set()
+        self.__fd = None
+        self.__mount_fds = dict()
+        self.__watches = dict()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    @classmethod
+    def from_available(cls, filesystems=None, backend='auto'):
+        """Watch the mount points listed by DriveManager.list_available"""
+        from .drive import DriveManager
+        return cls([mountpoint for _, mountpoint in DriveManager.list_available(filesystems)], backend)
+
+    def start(self):
+        """Subscribe to the change events and start reading them in a thread"""
+        if self.backend in ('auto', 'fanotify'):
+            try:
+                self.__start_fanotify()
+                self.backend = 'fanotify'
+            except OSError as err:
+                if self.backend == 'fanotify':
+                    raise
+                logging.info("fanotify is not available (%s), using inotify", err)
+        if self.__fd is None:
+            self.__start_inotify()
+            self.backend = 'inotify'
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='ChangeJournal', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop reading the events and close the notification descriptors"""
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        for mount_fd in self.__mount_fds.values():
+            os.close(mount_fd)
+        self.__mount_fds.clear()
+        self.__watches.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def mark_dirty(self, path, recursive=False):
+        """Mark a directory dirty, with its sub-directories if recursive is set"""
+        with self.__lock:
+            self.__dirty[path] = self.__dirty.get(path, False) or recursive
+
+    def pop_dirty(self):
+        """
+        Get and reset the dirty directories
+
+        The directories below a recursively dirty directory are removed.
+
+        Returns:
+            sorted list of (directory, recursive), see Drive.enumerate_dirty
+        """
+        with self.__lock:
+            dirty, self.__dirty = self.__dirty, dict()
+            for path in self.__unwatched:
+                dirty[path] = True
+        recursive = {path for path, value in dirty.items() if value}
+        result = []
+        for path in sorted(dirty):
+            parent = os.path.dirname(path)
+            while parent not in recursive and parent != os.path.dirname(parent):
+                parent = os.path.dirname(parent)
+            if parent in recursive and parent != path:
+                continue
+            result.append((path, dirty[path]))
+        return result
+
+    def __mark_overflow(self):
+        self.overflows += 1
+        logging.warning("Change journal overflow, the watched mount points are dirty")
+        for path in self.paths:
+            self.mark_dirty(path, True)
+
+    def __start_fanotify(self):
+        fd = _libc.fanotify_init(FAN_CLOEXEC | FAN_NONBLOCK | FAN_REPORT_DFID_NAME, os.O_RDONLY)
+        if fd < 0:
+            raise _errno_error()
+        try:
+            for path in self.paths:
+                if _libc.fanotify_mark(fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM, FAN_WATCH_MASK, AT_FDCWD,
+                                       path.encode('utf-8')) < 0:
+                    raise _errno_error()
+                # The file handles of the events are opened relative to a descriptor of their file system
+                mount_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    fsid = _fsid(mount_fd)
+                except OSError:
+                    os.close(mount_fd)
+                    raise
+                if fsid in self.__mount_fds:
+                    os.close(mount_fd)
+                else:
+                    self.__mount_fds[fsid] = mount_fd
+        except OSError:
+            os.close(fd)
+            for mount_fd in self.__mount_fds.values():
+                os.close(mount_fd)
+            self.__mount_fds.clear()
+            raise
+        self.__fd = fd
+
+    def __start_inotify(self):
+        fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise _errno_error()
+        self.__fd = fd
+        for path in self.paths:
+            self.__watch_tree(path)
+
+    def __watch_tree(self, root):
+        """Add an inotify watch to a directory and its sub-directories on the same device"""
+        try:
+            device = os.stat(root).st_dev
+        except OSError:
+            return
+        pending = [root]
+        while pending:
+            path = pending.pop()
+            wd = _libc.inotify_add_watch(self.__fd, path.encode('utf-8', errors='surrogateescape'), IN_WATCH_MASK)
+            if wd < 0:
+                err = _errno_error()
+                if err.errno == errno.ENOSPC:
+                    logging.warning("Cannot watch %s, raise fs.inotify.max_user_watches", path)
+                    with self.__lock:
+                        self.__unwatched.add(path)
+                continue
+            self.__watches[wd] = path
+            try:
+                for entry in os.scandir(path):
+                    try:
+                        if entry.is_dir(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_dev == device:
+                            pending.append(entry.path)
+                    except OSError:
+                        continue
+            except OSError:
+                continue
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                readable, _, _ = select.select([self.__fd], [], [], self.POLL_INTERVAL)
+                if not readable:
+                    continue
+                data = os.read(self.__fd, self.READ_SIZE)
+            except BlockingIOError:
+                continue
+            except OSError:
+                logging.exception("Cannot read the change events")
+                break
+            if self.backend == 'fanotify':
+                self.__read_fanotify(data)
+            else:
+                self.__read_inotify(data)
+
+    def __read_inotify(self, data):
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + _INOTIFY_EVENT.size:offset + _INOTIFY_EVENT.size + length].rstrip(b'\0')
+            offset += _INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.__mark_overflow()
+                continue
+            if mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+            directory = self.__watches.get(wd)
+            if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                path = os.path.join(directory, os.fsdecode(name))
+                # Files may have been created before the watch is added, the whole new tree is dirty
+                self.__watch_tree(path)
+                self.mark_dirty(path, True)
+            self.mark_dirty(directory)
+
+    def __read_fanotify(self, data):
+        offset = 0
+        while offset + _FANOTIFY_EVENT.size <= len(data):
+            event_length, _, _, metadata_length, mask, fd, _ = _FANOTIFY_EVENT.unpack_from(data, offset)
+            if event_length < _FANOTIFY_EVENT.size:
+                break
+            event = data[offset:offset + event_length]
+            offset += event_length
+            if fd >= 0:
+                os.close(fd)
+            if mask & FAN_Q_OVERFLOW:
+                self.__mark_overflow()
+                continue
+            info_offset = metadata_length
+            while info_offset + _FANOTIFY_INFO.size <= len(event):
+                info_type, _, info_length, fsid, handle_size, handle_type = _FANOTIFY_INFO.unpack_from(
+                    event, info_offset)
+                if info_length == 0:
+                    break
+                if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                    handle_start = info_offset + 12
+                    handle_end = handle_start + 8 + handle_size
+                    name = event[handle_end:info_offset + info_length].split(b'\0', 1)[0]
+                    directory = self.__resolve_handle(fsid, event[handle_start:handle_end])
+                    if directory is not None:
+                        self.__mark_fanotify(directory, os.fsdecode(name), mask)
+                info_offset += info_length
+
+    def __resolve_handle(self, fsid, handle):
+        """Get the path of a directory from its file handle, opened on the mount point of its file system"""
+        mount_fd = self.__mount_fds.get(fsid)
+        if mount_fd is None:
+            return None
+        fd = _libc.open_by_handle_at(mount_fd, handle, O_PATH)
+        if fd < 0:
+            return None
+        try:
+            return os.readlink('/proc/self/fd/{}'.format(fd))
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+    def __mark_fanotify(self, directory, name, mask):
+        if not any(_is_below(directory, path) for path in self.paths):
+            # The whole file system is marked, ignore the changes outside of the watched mount points
+            return
+        if mask & FAN_ONDIR and mask & (FAN_CREATE | FAN_MOVED_TO) and name:
+            self.mark_dirty(os.path.join(directory, name), True)
+        self.mark_dirty(directory)
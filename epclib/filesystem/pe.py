@@ -0,0 +1,210 @@
+"""
+pe.py : Header-only PE metadata extraction
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import struct
+
+PE32_MAGIC = 0x10b
+PE32PLUS_MAGIC = 0x20b
+
+DIRECTORY_ENTRY_IMPORT = 1
+DIRECTORY_ENTRY_SECURITY = 4
+
+MAX_SECTIONS = 96
+MAX_OPTIONAL_HEADER_SIZE = 4096
+MAX_IMPORT_DESCRIPTORS = 1024
+MAX_IMPORTS = 16384
+MAX_NAME_SIZE = 256
+THUNK_READ_COUNT = 256
+
+_COFF_HEADER = struct.Struct('<4sHHIIIHH')
+_SECTION_HEADER = struct.Struct('<8sIIIIIIHHI')
+_IMPORT_DESCRIPTOR = struct.Struct('<IIIII')
+_DATA_DIRECTORY = struct.Struct('<II')
+
+
+def _read_at(data_file, offset, length):
+    """Read length bytes at offset, returns less data at the end of the file"""
+    data_file.seek(offset)
+    return data_file.read(length)
+
+
+def _read_string(data_file, offset):
+    """Read a NULL terminated ascii string"""
+    data = _read_at(data_file, offset, MAX_NAME_SIZE)
+    return data.split(b'\0', 1)[0].decode('ascii', errors='replace')
+
+
+class _Sections(object):
+    """Map relative virtual addresses to file offsets using the section table"""
+
+    def __init__(self, sections):
+        self.__sections = sections
+
+    def rva_to_offset(self, rva):
+        for section in self.__sections:
+            start = section['virtual_address']
+            if start <= rva < start + max(section['virtual_size'], section['raw_size']):
+                return rva - start + section['raw_offset']
+        if not self.__sections or rva < min(section['virtual_address'] for section in self.__sections):
+            # The headers are mapped at the start of the image
+            return rva
+        return None
+
+
+def _parse_imports(data_file, sections, import_rva, is_64):
+    """Read the (dll, function) pairs of the import table"""
+    imports = []
+    offset = sections.rva_to_offset(import_rva)
+    if offset is None:
+        return imports
+    thunk_size = 8 if is_64 else 4
+    thunk_format = '<{}{}'.format(THUNK_READ_COUNT, 'Q' if is_64 else 'I')
+    ordinal_flag = 1 << (thunk_size * 8 - 1)
+
+    for index in range(MAX_IMPORT_DESCRIPTORS):
+        data = _read_at(data_file, offset + index * _IMPORT_DESCRIPTOR.size, _IMPORT_DESCRIPTOR.size)
+        if len(data) < _IMPORT_DESCRIPTOR.size:
+            break
+        original_first_thunk, _, _, name_rva, first_thunk = _IMPORT_DESCRIPTOR.unpack(data)
+        if not name_rva and not first_thunk:
+            break
+        name_offset = sections.rva_to_offset(name_rva)
+        thunk_offset = sections.rva_to_offset(original_first_thunk or first_thunk)
+        if name_offset is None or thunk_offset is None:
+            continue
+        dll = _read_string(data_file, name_offset)
+
+        done = False
+        while not done and len(imports) < MAX_IMPORTS:
+            data = _read_at(data_file, thunk_offset, thunk_size * THUNK_READ_COUNT)
+            if len(data) < thunk_size * THUNK_READ_COUNT:
+                data = data.ljust(thunk_size * THUNK_READ_COUNT, b'\0')
+                done = True
+            for thunk in struct.unpack(thunk_format, data):
+                if not thunk:
+                    done = True
+                    break
+                if thunk & ordinal_flag:
+                    imports.append([dll, 'ord{}'.format(thunk & 0xffff)])
+                else:
+                    hint_offset = sections.rva_to_offset(thunk & 0x7fffffff)
+                    if hint_offset is not None:
+                        imports.append([dll, _read_string(data_file, hint_offset + 2)])
+                if len(imports) >= MAX_IMPORTS:
+                    break
+            thunk_offset += thunk_size * THUNK_READ_COUNT
+        if len(imports) >= MAX_IMPORTS:
+            break
+    return imports
+
+
+def parse_pe_headers(data_file, imports=True):
+    """
+    Extract the metadata of a PE file from its headers with a few ranged reads
+
+    Only the DOS / NT headers, the section table and, if requested, the import table are read.
+
+    Args:
+        data_file: seekable file object
+        imports: read the import table (the imphash inputs)
+
+    Returns:
+        dict
+        None if the file is not a PE
+    """
+    dos_header = _read_at(data_file, 0, 64)
+    if len(dos_header) < 64 or dos_header[:2] != b'MZ':
+        return None
+    pe_offset = struct.unpack_from('<I', dos_header, 0x3c)[0]
+
+    coff_header = _read_at(data_file, pe_offset, _COFF_HEADER.size)
+    if len(coff_header) < _COFF_HEADER.size:
+        return None
+    (signature, machine, section_count, timestamp, _, _,
+     optional_header_size, characteristics) = _COFF_HEADER.unpack(coff_header)
+    if signature != b'PE\0\0' or optional_header_size > MAX_OPTIONAL_HEADER_SIZE:
+        return None
+    section_count = min(section_count, MAX_SECTIONS)
+
+    headers = _read_at(data_file, pe_offset + _COFF_HEADER.size,
+                       optional_header_size + section_count * _SECTION_HEADER.size)
+    if len(headers) < optional_header_size or optional_header_size < 2:
+        return None
+    magic = struct.unpack_from('<H', headers, 0)[0]
+    if magic == PE32PLUS_MAGIC and optional_header_size >= 112:
+        is_64 = True
+        entry_point = struct.unpack_from('<I', headers, 16)[0]
+        image_base = struct.unpack_from('<Q', headers, 24)[0]
+        directory_count = struct.unpack_from('<I', headers, 108)[0]
+        directories_offset = 112
+    elif magic == PE32_MAGIC and optional_header_size >= 96:
+        is_64 = False
+        entry_point = struct.unpack_from('<I', headers, 16)[0]
+        image_base = struct.unpack_from('<I', headers, 28)[0]
+        directory_count = struct.unpack_from('<I', headers, 92)[0]
+        directories_offset = 96
+    else:
+        return None
+    subsystem, dll_characteristics = struct.unpack_from('<HH', headers, 68)
+
+    directories = []
+    for index in range(min(directory_count, (optional_header_size - directories_offset) // _DATA_DIRECTORY.size)):
+        directories.append(_DATA_DIRECTORY.unpack_from(headers, directories_offset + index * _DATA_DIRECTORY.size))
+
+    sections = []
+    for index in range(section_count):
+        offset = optional_header_size + index * _SECTION_HEADER.size
+        if offset + _SECTION_HEADER.size > len(headers):
+            break
+        (name, virtual_size, virtual_address, raw_size, raw_offset,
+         _, _, _, _, section_characteristics) = _SECTION_HEADER.unpack_from(headers, offset)
+        sections.append(dict(
+            name=name.rstrip(b'\0').decode('utf-8', errors='replace'),
+            virtual_address=virtual_address,
+            virtual_size=virtual_size,
+            raw_offset=raw_offset,
+            raw_size=raw_size,
+            characteristics=section_characteristics,
+        ))
+
+    metadata = dict(
+        machine=machine,
+        timestamp=timestamp,
+        characteristics=characteristics,
+        is_64=is_64,
+        entry_point=entry_point,
+        image_base=image_base,
+        subsystem=subsystem,
+        dll_characteristics=dll_characteristics,
+        sections=sections,
+        signed=False,
+        imports=None,
+    )
+    if len(directories) > DIRECTORY_ENTRY_SECURITY:
+        security_offset, security_size = directories[DIRECTORY_ENTRY_SECURITY]
+        metadata['signed'] = bool(security_offset and security_size)
+    if imports and len(directories) > DIRECTORY_ENTRY_IMPORT and directories[DIRECTORY_ENTRY_IMPORT][0]:
+        try:
+            metadata['imports'] = _parse_imports(
+                data_file, _Sections(sections), directories[DIRECTORY_ENTRY_IMPORT][0], is_64)
+        except (struct.error, ValueError, OSError):
+            metadata['imports'] = None
+    return metadata
+
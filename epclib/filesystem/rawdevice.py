@@ -0,0 +1,280 @@
+"""
+rawdevice.py : Raw reads of disks, volumes and images
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import mmap
+import os
+import stat
+import threading
+
+try:
+    import fcntl
+    FCNTL_SUPPORT = True
+except ImportError:
+    FCNTL_SUPPORT = False
+    pass
+
+try:
+    import pytsk3
+    TSK_SUPPORT = True
+except ImportError:
+    TSK_SUPPORT = False
+    pass
+
+BLKSSZGET = 0x1268
+DEFAULT_SECTOR_SIZE = 512
+# Alignment of the O_DIRECT reads of regular files (the logical block size of most file systems)
+FILE_ALIGNMENT = 4096
+# Reads larger than this use a temporary buffer, the buffer kept between reads stays below this size
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class RawDevice(object):
+    """
+    Read-only access to a device or an image with positioned reads
+
+    The device is opened on the first read, with O_DIRECT where supported so the reads bypass the page cache.
+    Direct reads need buffers, offsets and lengths aligned on the sector size: the reads are widened to whole
+    sectors and done in page-aligned buffers. The last read window is kept so that the small reads of libtsk
+    (inode tables, directory blocks...) are served from it, readahead sets its minimum size.
+    """
+
+    def __init__(self, path, direct=True, readahead=128 * 1024):
+        """
+        Args:
+            path: device (ex: /dev/sda1, \\\\.\\C:) or image file
+            direct: bypass the page cache (O_DIRECT) if supported
+            readahead: minimum size of a read, 0 disables the read window
+        """
+        self.path = path
+        self.direct = direct
+        self.readahead = readahead
+        self.sector_size = DEFAULT_SECTOR_SIZE
+        self.reads = 0
+        self.bytes_read = 0
+        self.__fd = None
+        self.__size = None
+        self.__is_direct = False
+        self.__lock = threading.Lock()
+        self.__buffer = None
+        self.__window_offset = 0
+        self.__window_length = 0
+
+    def open(self):
+        """Open the device, called by the first read"""
+        with self.__lock:
+            self.__open()
+
+    def __open(self):
+        if self.__fd is not None:
+            return
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+        fd = None
+        if self.direct and hasattr(os, 'O_DIRECT'):
+            try:
+                fd = os.open(self.path, flags | os.O_DIRECT)
+                self.__is_direct = True
+            except OSError:
+                # tmpfs and some network file systems refuse O_DIRECT
+                fd = None
+        if fd is None:
+            fd = os.open(self.path, flags)
+            self.__is_direct = False
+
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            if FCNTL_SUPPORT:
+                try:
+                    sector_size = bytearray(4)
+                    fcntl.ioctl(fd, BLKSSZGET, sector_size)
+                    self.sector_size = int.from_bytes(sector_size, 'little') or DEFAULT_SECTOR_SIZE
+                except OSError:
+                    pass
+        elif self.__is_direct:
+            self.sector_size = FILE_ALIGNMENT
+        self.__size = os.lseek(fd, 0, os.SEEK_END)
+        self.__fd = fd
+
+    @property
+    def is_direct(self):
+        """The reads bypass the page cache"""
+        return self.__is_direct
+
+    def get_size(self):
+        """Size of the device in bytes"""
+        with self.__lock:
+            self.__open()
+            return self.__size
+
+    def close(self):
+        with self.__lock:
+            if self.__fd is not None:
+                os.close(self.__fd)
+                self.__fd = None
+            if self.__buffer is not None:
+                self.__buffer.close()
+                self.__buffer = None
+            self.__window_length = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __align(self, offset, length):
+        """Widen a range to whole sectors"""
+        start = offset - offset % self.sector_size
+        end = offset + length
+        end += -end % self.sector_size
+        return start, end - start
+
+    def __get_buffer(self, size):
+        """Page-aligned buffer of at least size bytes, reused between reads up to MAX_BUFFER_SIZE"""
+        if self.__buffer is None or len(self.__buffer) < size:
+            if self.__buffer is not None:
+                self.__buffer.close()
+            self.__buffer = mmap.mmap(-1, max(size, mmap.PAGESIZE))
+            self.__window_length = 0
+        return self.__buffer
+
+    def __release_buffer(self):
+        """Drop the buffer after an oversized read so that it is not kept for the life of the device"""
+        if self.__buffer is not None and len(self.__buffer) > MAX_BUFFER_SIZE:
+            self.__buffer.close()
+            self.__buffer = None
+            self.__window_length = 0
+
+    def __pread(self, buffer, offset, length):
+        """Read an aligned range into an aligned buffer, returns the number of bytes read"""
+        self.reads += 1
+        if hasattr(os, 'preadv'):
+            view = memoryview(buffer)[:length]
+            try:
+                read = 0
+                while read < length:
+                    count = os.preadv(self.__fd, [view[read:]], offset + read)
+                    if count <= 0:
+                        break
+                    read += count
+            finally:
+                view.release()
+        else:
+            data = os.pread(self.__fd, length, offset) if hasattr(os, 'pread') else self.__seek_read(offset, length)
+            buffer[:len(data)] = data
+            read = len(data)
+        self.bytes_read += read
+        return read
+
+    def __seek_read(self, offset, length):
+        os.lseek(self.__fd, offset, os.SEEK_SET)
+        return os.read(self.__fd, length)
+
+    def read(self, offset, length):
+        """
+        Read some data from the device
+
+        Args:
+            offset: offset from the start of the device
+            length: number of bytes to read
+
+        Returns:
+            bytes, shorter than length at the end of the device
+        """
+        if length <= 0 or offset < 0:
+            return b''
+        with self.__lock:
+            self.__open()
+            length = max(0, min(length, self.__size - offset))
+            if not length:
+                return b''
+            window_offset = self.__window_offset
+            if window_offset <= offset and offset + length <= window_offset + self.__window_length:
+                start = offset - window_offset
+                return self.__buffer[start:start + length]
+
+            start, aligned_length = self.__align(offset, max(length, self.readahead))
+            buffer = self.__get_buffer(aligned_length)
+            read = self.__pread(buffer, start, aligned_length)
+            self.__window_offset, self.__window_length = start, read
+            data = buffer[offset - start:min(offset - start + length, read)]
+            self.__release_buffer()
+            return data
+
+    def read_extents(self, extents, merge_gap=64 * 1024, max_read=MAX_BUFFER_SIZE):
+        """
+        Read several ranges of the device at once
+
+        The extents are read in ascending offset order, the ones closer than merge_gap are merged into a single
+        read of at most max_read bytes (a larger extent is read alone).
+
+        Args:
+            extents: list of (offset, length)
+            merge_gap: maximum number of unneeded bytes read to merge two extents
+            max_read: maximum size of a merged read
+
+        Returns:
+            list of bytes, in the order of extents
+        """
+        results = [b''] * len(extents)
+        order = sorted((offset, length, index) for index, (offset, length) in enumerate(extents) if length > 0)
+        with self.__lock:
+            self.__open()
+            position = 0
+            while position < len(order):
+                # Extents of the merged read
+                first = position
+                run_start = order[position][0]
+                run_end = order[position][0] + order[position][1]
+                position += 1
+                while (position < len(order) and order[position][0] <= run_end + merge_gap and
+                       max(run_end, order[position][0] + order[position][1]) - run_start <= max_read):
+                    run_end = max(run_end, order[position][0] + order[position][1])
+                    position += 1
+                run_end = min(run_end, self.__size)
+                if run_start >= run_end:
+                    continue
+
+                start, aligned_length = self.__align(run_start, run_end - run_start)
+                buffer = self.__get_buffer(aligned_length)
+                read = self.__pread(buffer, start, aligned_length)
+                self.__window_offset, self.__window_length = start, read
+                for offset, length, index in order[first:position]:
+                    begin = offset - start
+                    results[index] = buffer[begin:min(begin + length, read)] if begin < read else b''
+                self.__release_buffer()
+        return results
+
+
+if TSK_SUPPORT:
+    class RawImgInfo(pytsk3.Img_Info):
+        """libtsk image backed by a RawDevice, libtsk then reads through its aligned reads and read window"""
+
+        def __init__(self, raw_device):
+            self.raw_device = raw_device
+            super(RawImgInfo, self).__init__(url='', type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+        def close(self):
+            self.raw_device.close()
+
+        def read(self, offset, size):
+            return self.raw_device.read(offset, size)
+
+        def get_size(self):
+            return self.raw_device.get_size()
@@ -0,0 +1,121 @@
+"""
+ruleset.py : Compiled yara rulesets
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+import yara
+
+from epc.common.settings import Config
+
+# Externals given to the rules by the scan_yara methods, they must be declared at compile time
+YARA_EXTERNALS = dict(
+    filename='',
+    filepath='',
+    extension='',
+    filetype='',
+    md5='',
+)
+
+
+class YaraRuleset(object):
+    """
+    Single compiled yara ruleset built from several rule sources, one namespace per source
+
+    The compiled rules are saved in the cache directory, keyed by a hash of the sources, so they are only
+    compiled again when the sources change.
+    """
+    PREFIX = 'yara-'
+    SUFFIX = '.bin'
+
+    def __init__(self, sources, cache_dir=None):
+        """
+        Args:
+            sources: dict of namespace -> yara rule source
+            cache_dir: directory of the compiled rulesets (default BINCACHE_DIR)
+        """
+        self.sources = dict(sources)
+        self.cache_dir = Path(cache_dir if cache_dir else Config().BINCACHE_DIR)
+        self.__rules = None
+
+    @classmethod
+    def from_files(cls, paths, cache_dir=None):
+        """Build a ruleset from rule files, the namespace of each file is its name without extension"""
+        sources = dict()
+        for path in paths:
+            path = Path(path)
+            with path.open('r', encoding='utf-8', errors='replace') as ifile:
+                sources[path.stem] = ifile.read()
+        return cls(sources, cache_dir)
+
+    @property
+    def key(self):
+        """Hash of the rule sources"""
+        digest = hashlib.sha256()
+        for namespace in sorted(self.sources):
+            digest.update(namespace.encode('utf-8'))
+            digest.update(b'\0')
+            digest.update(self.sources[namespace].encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    @property
+    def path(self):
+        """Path of the compiled ruleset"""
+        return self.cache_dir / '{}{}{}'.format(self.PREFIX, self.key, self.SUFFIX)
+
+    def get_rules(self):
+        """
+        Get the compiled rules, loading them from the cache or compiling them
+
+        Returns:
+            yara.Rules
+        """
+        if self.__rules is None:
+            self.__rules = self.__load() or self.__compile()
+        return self.__rules
+
+    def match(self, *args, **kwargs):
+        """Match the compiled rules, see yara.Rules.match"""
+        return self.get_rules().match(*args, **kwargs)
+
+    def __load(self):
+        path = self.path
+        if not path.exists():
+            return None
+        try:
+            return yara.load(str(path))
+        except yara.Error:
+            logging.warning("Cannot load the compiled yara rules %s", path)
+            return None
+
+    def __compile(self):
+        rules = yara.compile(sources=self.sources, externals=YARA_EXTERNALS)
+        try:
+            os.makedirs(str(self.cache_dir), exist_ok=True)
+            path = self.path
+            tmp_path = path.with_suffix('.tmp')
+            rules.save(str(tmp_path))
+            os.replace(str(tmp_path), str(path))
+        except (OSError, yara.Error):
+            logging.exception("Cannot save the compiled yara rules")
+        return rules